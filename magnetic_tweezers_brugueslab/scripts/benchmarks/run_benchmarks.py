@@ -0,0 +1,215 @@
+'''
+Benchmarks of the serial and control hot paths, run against the virtual devices (no hardware needed, Linux/macOS).
+
+Measures throughput and p50/p99 latency of
+    single_command  - send_string(..., wait_for_answer=True) round trip, per payload size
+    set_and_sense   - one set + sense pair (my_funcs.set_and_sense), ASCII and binary protocol
+    readline        - serialConnection.readline() on lines that are already received
+    injectman_encode- encoding the commands of InjectMan.call_command_code and parsing the position (no I/O)
+    multi_box       - a full (short) multi_box run: achieved loop rate and tick lateness
+for the polling and the reader thread mode and a matrix of baud rates.
+
+Usage (from this folder):
+    python run_benchmarks.py                        # results go to results/benchmark_<date>_<time>.json
+    python run_benchmarks.py --quick                # fewer repetitions, for a quick check
+    python run_benchmarks.py --compare results/old.json    # print the change against an earlier run
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import numpy as np
+
+_scripts = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_scripts, 'inject_man'))
+sys.path.insert(0, os.path.join(_scripts, 'voltage_control'))
+
+import serial
+import my_funcs
+import waveforms
+import inject_man
+from serial_connection import serialConnection
+from virtual_arduino import VirtualArduino
+
+
+baud_rates = [9600, 19200, 115200, None]  # None: no emulation of the line speed
+payload_sizes = [8, 32, 128]  # bytes of the command of single_command
+modes = ['polling', 'reader_thread']
+
+
+def _summary(latencies_s, t_total_s, **parameters) -> dict:
+    latencies_ms = np.asarray(latencies_s) * 1e3
+    return dict(parameters,
+                n=len(latencies_ms),
+                throughput_per_s=len(latencies_ms) / t_total_s if t_total_s > 0 else 0,
+                mean_ms=float(latencies_ms.mean()),
+                p50_ms=float(np.percentile(latencies_ms, 50)),
+                p99_ms=float(np.percentile(latencies_ms, 99)))
+
+
+def _timed(f, n: int, **parameters) -> dict:
+    latencies = np.empty(n)
+    t_start = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter()
+        f()
+        latencies[i] = time.perf_counter() - t
+    return _summary(latencies, time.perf_counter() - t_start, **parameters)
+
+
+def _connect(device, baud_rate, mode, protocol='ascii') -> serialConnection:
+    # The virtual device does not reset, so the port is opened here to skip the wait for the bootloader.
+    port = serial.Serial(device.port, baud_rate or 115200, timeout=0.1)
+    return serialConnection(port=device.port, baud_rate=baud_rate, string_terminator='\r', protocol=protocol,
+                            use_reader_thread=(mode == 'reader_thread'), serial_port=port)
+
+
+def bench_single_command(n: int) -> list:
+    results = []
+    for baud_rate in baud_rates:
+        with VirtualArduino(baud_rate=baud_rate) as device:
+            for mode in modes:
+                sc = _connect(device, baud_rate, mode)
+                for payload in payload_sizes:
+                    # Unknown commands are echoed back ('E <command>'), so the answer grows with the command.
+                    command = '?X' + 'x'*(payload - 3)
+                    results.append(_timed(lambda: sc.send_string(command, wait_for_answer=True), n,
+                                          benchmark='single_command', mode=mode, baud_rate=baud_rate, payload_bytes=payload))
+                sc.close()
+    return results
+
+
+def bench_set_and_sense(n: int) -> list:
+    results = []
+    for baud_rate in baud_rates:
+        for protocol in ['ascii', 'binary']:
+            with VirtualArduino(baud_rate=baud_rate, protocol=protocol) as device:
+                for mode in modes:
+                    sc = _connect(device, baud_rate, mode, protocol)
+                    results.append(_timed(lambda: my_funcs.set_and_sense(sc, 0, 1000), n,
+                                          benchmark='set_and_sense', mode=mode, baud_rate=baud_rate, protocol=protocol))
+                    sc.close()
+    return results
+
+
+def bench_readline(n: int) -> list:
+    results = []
+    with VirtualArduino() as device:
+        sc = _connect(device, None, 'polling')
+        for lines_per_write in [1, 10, 100]:
+            batch = ''.join(f'?SS {i}\r' for i in range(lines_per_write))
+            latencies = []
+            t_total = 0
+            for _ in range(max(1, n // lines_per_write)):
+                sc.send_string(batch.rstrip('\r'))
+                # Wait until all the answers are in the OS buffer, so only the framing is measured.
+                t_wait = time.perf_counter() + 1
+                while sc.serial.in_waiting < 7 * lines_per_write and time.perf_counter() < t_wait:
+                    time.sleep(0.001)
+                time.sleep(0.002)
+                for _ in range(lines_per_write):
+                    t = time.perf_counter()
+                    sc.readline()
+                    latencies.append(time.perf_counter() - t)
+                    t_total += latencies[-1]
+            results.append(_summary(latencies, t_total, benchmark='readline', lines_per_write=lines_per_write))
+        sc.close()
+    return results
+
+
+def bench_injectman_encode(n: int) -> list:
+    im = inject_man.InjectMan(is_simulated=True)
+    return [
+        _timed(lambda: im._command_bytes(10), n, benchmark='injectman_encode', command='C010'),
+        _timed(lambda: im._command_bytes(7, 100, 200, 300, 1000, 1000, 1000), n, benchmark='injectman_encode', command='C007'),
+        _timed(lambda: im.call_command_code(10), n, benchmark='injectman_call_simulated', command='C010'),
+        _timed(lambda: im._parse_position_reply('A010 12595 -3400 778 16', im._position_reply), n,
+               benchmark='injectman_parse', command='A010'),
+    ]
+
+
+def bench_multi_box(t_on: float, dT: float) -> list:
+    results = []
+    for baud_rate in baud_rates:
+        with VirtualArduino(baud_rate=baud_rate) as device:
+            for mode in modes:
+                sc = _connect(device, baud_rate, mode)
+                pulses = waveforms.multi_box(t_on, t_on, 2, 1000)
+                # Without most of the pause after the pulses.
+                waveform = waveforms.Waveform(pulses.breakpoints, pulses.values, waveforms.t_signal_start + 4*t_on)
+                measurements = my_funcs.run_waveform(waveform, 0, sc, dT=dT)
+                timing = measurements.metadata['timing']
+                round_trips = measurements['t_meas'] - measurements['t_set']
+                results.append(_summary(round_trips, waveform.t_end, benchmark='multi_box', mode=mode, baud_rate=baud_rate, dT=dT,
+                                        rate=timing['rate'], rate_requested=timing['rate_requested'],
+                                        n_missed=timing['n_missed'], lateness_p99_ms=timing['lateness_p99_ms']))
+                sc.close()
+    return results
+
+
+def _environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=_scripts).stdout.strip()
+    except OSError:
+        commit = None
+    return {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'platform': platform.platform(), 'pyserial': serial.__version__, 'numpy': np.__version__}
+
+
+def _key(result: dict) -> tuple:
+    # Everything but the measured values identifies a benchmark case.
+    measured = {'n', 'throughput_per_s', 'mean_ms', 'p50_ms', 'p99_ms', 'rate', 'n_missed', 'lateness_p99_ms'}
+    return tuple(sorted((k, str(v)) for k, v in result.items() if k not in measured))
+
+
+def compare(results: list, reference: list):
+    """Print the change of p50 latency and throughput against an earlier run."""
+    reference = {_key(r): r for r in reference}
+    print(f"{'case':<80} {'p50 [ms]':>20} {'throughput [1/s]':>24}")
+    for r in results:
+        old = reference.get(_key(r))
+        if old is None:
+            continue
+        case = ' '.join(f'{k}={v}' for k, v in _key(r))
+        print(f"{case:<80} {old['p50_ms']:>8.3f} -> {r['p50_ms']:<8.3f} "
+              f"{old['throughput_per_s']:>10.0f} -> {r['throughput_per_s']:<10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the serial and control hot paths.')
+    parser.add_argument('--quick', action='store_true', help='fewer repetitions')
+    parser.add_argument('--output', help='JSON file for the results (default: results/benchmark_<date>_<time>.json)')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    n = 50 if args.quick else 500
+    results = []
+    for name, bench in [('single_command', lambda: bench_single_command(n)),
+                        ('set_and_sense', lambda: bench_set_and_sense(n)),
+                        ('readline', lambda: bench_readline(10*n)),
+                        ('injectman_encode', lambda: bench_injectman_encode(100*n)),
+                        ('multi_box', lambda: bench_multi_box(0.25 if args.quick else 1, 0.01))]:
+        print(f'--- {name}')
+        results += bench()
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         time.strftime('benchmark_%Y%m%d_%H%M%S.json'))
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'environment': _environment(), 'results': results}, f, indent=1)
+    print(f'Results saved to {output}')
+
+    for r in results:
+        print(' '.join(f'{k}={v:.3f}' if isinstance(v, float) else f'{k}={v}' for k, v in r.items()))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import logging
+import asyncio
+import time
+import serial
+from collections import deque
+
+import command_trace
+
+
+class asyncSerialConnection:
+	def __init__(self,
+				 port,
+				 baud_rate=9600,
+				 string_terminator = '\n',
+				 answer_timeout=1.0,
+				 boot_time=3,
+				 serial_port=None
+				) -> None:
+		"""
+		asyncio version of serialConnection (ASCII protocol), for running several devices and profiles in one
+		event loop.
+
+		The port is read when the event loop reports its file descriptor readable (loop.add_reader), so waiting for
+		an answer costs no CPU. Where the port has no file descriptor (Windows) or the event loop can not watch it
+		(ProactorEventLoop), a reader task does the blocking reads in a worker thread instead.
+		Call `await sc.open()` before the first command.
+
+		:param answer_timeout: maximal time in s to wait for an answer
+		:param boot_time: time in s to wait in open() for the Arduino bootloader after the port is opened
+		:param serial_port: already opened port object to use instead of opening port
+		"""
+		self.port = port
+		self.baud_rate = baud_rate
+		self.string_terminator = string_terminator
+		self.answer_timeout = answer_timeout
+		self.boot_time = boot_time
+
+		if serial_port is not None:
+			self.serial = serial_port
+			self.boot_time = 0
+		else:
+			self.serial = serial.Serial(self.port, self.baud_rate, timeout=0.1)
+		logging.info(f'Serial opened on port {self.port} with baud rate {self.baud_rate}')
+
+		self.buf = bytearray()
+		self._pending_answers = deque()
+		self._unsolicited_lines = None
+		self._loop = None
+		self._reader_fd = None
+		self._reader_task = None
+
+	async def open(self):
+		"""Wait for the device to boot and start reading the port in the running event loop."""
+		self._loop = asyncio.get_running_loop()
+		self._unsolicited_lines = asyncio.Queue()
+		if self.boot_time > 0:
+			await asyncio.sleep(self.boot_time)
+
+		try:
+			fd = self.serial.fileno()
+			self._loop.add_reader(fd, self._on_readable)
+			self._reader_fd = fd
+		except (AttributeError, NotImplementedError, OSError, serial.SerialException):
+			self._reader_task = self._loop.create_task(self._reader_task_loop())
+		return self
+
+	async def send_string(self, string_to_send, wait_for_answer=False, timeout=None):
+		"""timeout: time in s to wait for the answer instead of answer_timeout (see serialConnection.send_string())."""
+		encoded_string = (string_to_send + self.string_terminator).encode()
+		answers = await self._send_encoded(encoded_string, [string_to_send], wait_for_answer, timeout)
+		return answers[0] if wait_for_answer else None
+
+	async def send_bytes(self, encoded_string, wait_for_answer=False, timeout=None):
+		"""send_string() for a command that is already encoded, with the terminator."""
+		answers = await self._send_encoded(encoded_string, [encoded_string], wait_for_answer, timeout)
+		return answers[0] if wait_for_answer else None
+
+	async def send_strings(self, strings_to_send, wait_for_answer=True):
+		"""
+		Send several commands in one write and return their answers (decoded and stripped) in the same order.
+
+		Every command has to produce exactly one answer line.
+		"""
+		encoded_strings = ''.join(s + self.string_terminator for s in strings_to_send).encode()
+		return await self._send_encoded(encoded_strings, strings_to_send, wait_for_answer)
+
+	async def _send_encoded(self, encoded_strings, strings_to_send, wait_for_answer, timeout=None):
+		t_send = time.perf_counter()
+
+		if not wait_for_answer:
+			self.serial.write(encoded_strings)
+			if command_trace.enabled:
+				command_trace.record_batch(self.port, strings_to_send, None, t_send)
+			return None
+
+		futures = [self._loop.create_future() for _ in strings_to_send]
+		self._drop_expired()
+		# Registered before the write, so a fast answer can not be given to nobody.
+		self._pending_answers.extend(futures)
+		self.serial.write(encoded_strings)
+		try:
+			timeout = self.answer_timeout * len(futures) if timeout is None else timeout
+			answers = await asyncio.wait_for(asyncio.gather(*futures), timeout)
+		except asyncio.TimeoutError:
+			# The futures are cancelled but stay in the queue: a late answer is consumed (and dropped) by its own
+			# request instead of being handed to the next caller.
+			t_expired = time.perf_counter()
+			for future in futures:
+				future.t_expired = t_expired
+			raise
+		answers = [answer.decode().strip() for answer in answers]
+		if command_trace.enabled:
+			command_trace.record_batch(self.port, strings_to_send, answers, t_send, time.perf_counter())
+		return answers
+
+	def _drop_expired(self):
+		"""
+		Drop the timed out requests at the front of the queue that expired more than answer_timeout ago (their
+		answers are taken as lost), so they do not swallow the answers of later requests.
+		"""
+		pending = self._pending_answers
+		now = time.perf_counter()
+		while pending and pending[0].cancelled() and now - getattr(pending[0], 't_expired', now) > self.answer_timeout:
+			pending.popleft()
+
+	async def readline(self):
+		"""Line nobody was waiting for, or '' if none arrives within the port timeout."""
+		try:
+			return await asyncio.wait_for(self._unsolicited_lines.get(), self.serial.timeout)
+		except asyncio.TimeoutError:
+			return ''
+
+	def close(self):
+		if self._reader_fd is not None:
+			self._loop.remove_reader(self._reader_fd)
+			self._reader_fd = None
+		if self._reader_task is not None:
+			self._reader_task.cancel()
+			self._reader_task = None
+		self.serial.close()
+
+	# ------------------------------------------------------------------------------
+	# Reading
+
+	def _on_readable(self):
+		try:
+			data = self.serial.read(max(1, self.serial.in_waiting))
+		except (OSError, serial.SerialException):
+			self._loop.remove_reader(self._reader_fd)
+			self._reader_fd = None
+			return
+		self._received(data)
+
+	async def _reader_task_loop(self):
+		while True:
+			try:
+				data = await self._loop.run_in_executor(None, self._blocking_read)
+			except (OSError, TypeError, AttributeError, serial.SerialException):
+				break
+			self._received(data)
+
+	def _blocking_read(self):
+		return self.serial.read(max(1, self.serial.in_waiting))
+
+	def _received(self, data):
+		self.buf.extend(data)
+		i = self.buf.find(b'\n')
+		while i >= 0:
+			line = bytes(self.buf[:i+1])
+			del self.buf[:i+1]
+			self._dispatch_line(line)
+			i = self.buf.find(b'\n')
+
+	def _dispatch_line(self, line):
+		if not self._pending_answers:
+			self._unsolicited_lines.put_nowait(line)
+			return
+		future = self._pending_answers.popleft()
+		# A cancelled caller (timed out, or task cancelled while waiting) still consumes its answer.
+		if not future.done():
+			future.set_result(line)
+		else:
+			logging.warning(f'Late answer on port {self.port} dropped: {line}')
@@ -1,10 +1,28 @@
+import json
 import logging
-
+import re
 import time
+import threading
 
+import numpy as np
 
 import serial_connection
+import async_serial_connection
+import command_trace
+from path_follower import PathFollower
+from position_service import Move, PositionService
+
+
+
+# Answer of the position query: A010 d1 d2 d3 limit_switches
+_position_reply = re.compile(r'\s*[aA]010 (-?\d+) (-?\d+) (-?\d+) (-?\d+)')
 
+# Calibration of the angle of the third motor (see set_calibration()), for the setup in the lab.
+default_calibration = {'d1_calib': 11917, 'd3_calib': 15557, 'z_calib': 1e4}
+
+
+# Commands after which the motors stand still at an unknown position (see InjectMan._track_stop()).
+_stopping_commands = {3, 4, 5, 8, 'C003', 'C004', 'C005', 'C008'}
 
 
 class InjectMan:
@@ -12,14 +30,24 @@ class InjectMan:
 				 port='COM1',
 				 baud_rate=19200,
 				 is_simulated=False,
-				 default_speed=1000
+				 default_speed=1000,
+				 use_reader_thread=False,
+				 use_asyncio=False,
+				 calibration=None
 				 ) -> None:
-		""" Documentation of the class missing"""
+		""" Documentation of the class missing
+
+		:param calibration: d1_calib, d3_calib and z_calib of the setup (see set_calibration()), as a dict or the
+						path of a JSON file with them. Default: default_calibration.
+		"""
 		# TODO: write the documentation.
 		self.port = port
 		self.baud_rate = baud_rate
 		self.is_simulated = is_simulated	# the InjectMan is simulated. no connection will be made and the object can be used for testing.
 		self.default_speed = default_speed	# Default speed in micrometers/s for the movement of the motors.
+		self.use_reader_thread = use_reader_thread	# Answers are read by a background thread of the serial connection.
+		self.use_asyncio = use_asyncio	# The connection is opened with `await connect_async()` and used by the *_async methods.
+		self.string_terminator = '\n'	# End of the commands sent to InjectMan.
 		
 		
 		# ---------------------------------------------------------------------
@@ -28,24 +56,56 @@ class InjectMan:
 		self.speed_max_micrometers = 7500  # Maximum speed in micrometers/s
 		
 		# Angle of the third motor
-		d1_calib = 11917
-		d3_calib = 15557
-		z_calib = 1e4
-		self.sin_theta = d1_calib / d3_calib
-		self.cos_theta = z_calib / d3_calib
+		if calibration is None:
+			calibration = default_calibration
+		elif type(calibration) == str:
+			with open(calibration) as f:
+				calibration = json.load(f)
+		self.set_calibration(calibration['d1_calib'], calibration['d3_calib'], calibration['z_calib'])
 		
 		# ---------------------------------------------------------------------
+		# ### Command encoding
+		# Commands without parameters, ready to write (code or string -> bytes with the terminator), and the format
+		# of the commands with parameters (number of parameters -> bytes format).
+		self._encoded_commands = {}
+		self._command_formats = {}
+		# Reply of the last position query: d1, d2, d3, limit switches (see position_query_array())
+		self._position_reply = np.zeros(4, dtype=np.int64)
+		
+		# Motor position [d1, d2, d3] the InjectMan was last sent to (None if not known, then it is queried).
+		self.commanded_position = None
+		# A non blocking GOTO was sent and the motors may not be at commanded_position yet.
+		self._may_be_moving = False
+		# Last GOTO (time sent, start, target, speeds), None after STOP and similar; see position_service.py
+		self.last_move = None
+		# Commands can come from several threads (PositionService, PathFollower); one at a time on the port.
+		self._command_lock = threading.RLock()
 		
 		logging.info(f'InjectMan initialization...')
 		
-		if not is_simulated:
-			self.serial_connection = serial_connection.serialConnection(port=self.port, baud_rate=self.baud_rate)
+		self.serial_connection = None
+		if not is_simulated and not use_asyncio:
+			# The InjectMan does not reset when the port is opened, so it is ready as soon as it answers C001.
+			self.serial_connection = serial_connection.serialConnection(port=self.port, baud_rate=self.baud_rate,
+																		  string_terminator=self.string_terminator,
+																		  use_reader_thread=self.use_reader_thread,
+																		  reset_on_open=False, ready_answer='A001',
+																		  ready_probe='C001', ready_timeout=1.0)
 
 		logging.info(f'InjectMan init done. is_simulated = {self.is_simulated}')
 	
 
+	async def connect_async(self):
+		"""Open the asyncio connection (use_asyncio=True) in the running event loop."""
+		if not self.is_simulated:
+			self.serial_connection = async_serial_connection.asyncSerialConnection(port=self.port, baud_rate=self.baud_rate,
+																				   string_terminator=self.string_terminator,
+																				   boot_time=0)
+			await self.serial_connection.open()
+		return self
+
 	def close_serial(self):
-		self.serial_connection.serial.close()
+		self.serial_connection.close()
 
 	# ----------------------------------------------------------------------------------------------------------------
 	# Functions for commands of InjectMan. Their docstring include command description from the
@@ -72,7 +132,10 @@ class InjectMan:
 		Parameter: none
 		"""
 		command_code = 3
-		return self.call_command_code(command_code)
+		answer = self.call_command_code(command_code)
+		self.commanded_position = np.zeros(3)
+		self.last_move = None
+		return answer
 
 	def switch_to_remote_control(self):
 		"""
@@ -88,6 +151,9 @@ class InjectMan:
 		Parameter: none
 		"""
 		command_code = 4
+		# Movements are stopped where they are, so the position is not known any more.
+		self.commanded_position = None
+		self.last_move = None
 		return self.call_command_code(command_code)
 
 	def switch_to_manual_control(self):
@@ -104,6 +170,8 @@ class InjectMan:
 		Parameter: none
 		"""
 		command_code = 5
+		self.commanded_position = None
+		self.last_move = None
 		return self.call_command_code(command_code)
 
 	def GOTO_position_in_micrometers(self, px, py, pz, vx, vy, vz):
@@ -133,7 +201,10 @@ class InjectMan:
 		self._validate_parameters_range([px, py, pz], -self.position_max_micrometers, self.position_max_micrometers)
 		self._validate_parameters_range([vx, vy, vz], -self.speed_max_micrometers, self.speed_max_micrometers)
 		
-		return self.call_command_code(command_code, px, py, pz, vx, vy, vz)
+		t_send = time.perf_counter()
+		answer = self.call_command_code(command_code, px, py, pz, vx, vy, vz)
+		self._track_goto([px, py, pz], answer, [vx, vy, vz], t_send)
+		return answer
 
 	def STOP(self):
 		"""The current movement will be stopped.
@@ -143,6 +214,8 @@ class InjectMan:
 		remote control is active.
 		"""
 		command_code = 8
+		self.commanded_position = None
+		self.last_move = None
 		return self.call_command_code(command_code)
 
 	def position_query_in_micrometers(self):
@@ -169,6 +242,15 @@ class InjectMan:
 		position, limit_switches = self._parse_position_query(answer_string)
 		return position, limit_switches
 
+	def position_query_array(self, out=None):
+		"""
+		position_query_in_micrometers() for frequent queries: returns the integer array [d1, d2, d3, limit_switches].
+
+		Without out, the array is reused (overwritten) by the next call; copy it to keep it.
+		"""
+		out = self._position_reply if out is None else out
+		self._parse_position_reply(self.call_command_code(10), out)
+		return out
 
 
 	def GOTO_position_in_micrometers_NB(self, px, py, pz, vx, vy, vz):
@@ -199,7 +281,10 @@ class InjectMan:
 		self._validate_parameters_range([px, py, pz], -self.position_max_micrometers, self.position_max_micrometers)
 		self._validate_parameters_range([vx, vy, vz], -self.speed_max_micrometers, self.speed_max_micrometers)
 		
-		return self.call_command_code(command_code, px, py, pz, vx, vy, vz)
+		t_send = time.perf_counter()
+		answer = self.call_command_code(command_code, px, py, pz, vx, vy, vz)
+		self._track_goto([px, py, pz], answer, [vx, vy, vz], t_send)
+		return answer
 
 	def trigger_short_acoustic_signals(self, n):
 		"""The number of short (100 ms) acoustic
@@ -232,6 +317,10 @@ class InjectMan:
 		Parse position query answer to 2 lists.
 
 		"""
+		if _position_reply.match(answer_string):
+			reply = self._parse_position_reply(answer_string, self._position_reply)
+			return reply[:3].tolist(), reply[3:].tolist()
+
 		raw_list = answer_string.split(' ')
 		answer_code = raw_list.pop(0)
 		
@@ -246,6 +335,17 @@ class InjectMan:
 
 		return position, limit_switches
 
+	def _parse_position_reply(self, answer_string, out):
+		"""Write d1, d2, d3 and the limit switches of the answer 'A010 d1 d2 d3 ls' to the integer array out."""
+		match = _position_reply.match(answer_string)
+		if match is None:
+			raise Exception(f"Expecting the answer 'A010 d1 d2 d3 limit_switches', got: '{answer_string}'")
+		out[0] = int(match[1])
+		out[1] = int(match[2])
+		out[2] = int(match[3])
+		out[3] = int(match[4])
+		return out
+
 	def _validate_parameters_range(self, parameters_list, lim_min, lim_max):
 		"""
 		Validate parameters to be in the valid range. 
@@ -265,30 +365,6 @@ class InjectMan:
 								 \r Parameter was in the list of {parameters_list}.""")
 		return parameters_list
 
-	# def _movement_parameters_to_string(self, px, py, pz, vx, vy, vz):
-	def _code_and_parameters_to_string(self, code, *parameters):
-		"""
-		Return a string command with a code and parameters separated with spaces.
-
-		Example: 
-			_code_and_parameters_to_string(5, 10, 11, 12)
-			> C005 10 11 12
-		"""
-		# Transform numbers into strings
-		parameters = [str(x) for x in parameters]
-		
-		# Make string of parameters
-		parameters_str = " " if len(parameters) > 0 else ""
-		parameters_str += " ".join(parameters)
-		
-		
-		
-		logging.debug(f'_code_and_parameters_to_string(): code: {code} parameters_str: {parameters_str}')
-		
-		# Put it all together
-		command_string = f'C{code:03}{parameters_str}'
-		return command_string
-		
 	# custom command - with just string C001 (or int number: 1)
 	def call_command_code(self, command_name, *parameters: int):
 		"""
@@ -305,6 +381,89 @@ class InjectMan:
 					'C001 5 70', 123, 400 -> 'C001 5 70'
 			*parameters (int): integers to be added to the string message (separated with spaces)
 		"""
+		result = self.send_command_serial(self._command_bytes(command_name, *parameters),
+										  answer_timeout=self._answer_timeout(command_name, parameters))
+		self._track_stop(command_name)
+		return result
+
+	async def call_command_code_async(self, command_name, *parameters: int):
+		"""call_command_code() for the asyncio connection (see connect_async())."""
+		result = await self.send_command_serial_async(self._command_bytes(command_name, *parameters),
+													  answer_timeout=self._answer_timeout(command_name, parameters))
+		self._track_stop(command_name)
+		return result
+
+	def _answer_timeout(self, command_name, parameters):
+		"""
+		Time in s to wait for the answer (reader thread and asyncio), None for the answer_timeout of the connection.
+
+		The blocking GOTO (C007, also as a raw string) is answered only when the motors have stopped: it gets the
+		time of the longest motor way at its speed (from the commanded position, or across the whole range if the
+		motors may be elsewhere) plus the answer_timeout of the connection.
+		"""
+		if type(command_name) == str:
+			parts = command_name.split()
+			if not parts or parts[0].upper() != 'C007':
+				return None
+			parameters = parts[1:]
+		elif command_name != 7:
+			return None
+		try:
+			d = np.trunc(np.array(parameters[:3], dtype=float))
+			speeds = np.abs(np.array(parameters[3:6], dtype=float))
+		except ValueError:
+			return None
+		if len(d) != 3 or len(speeds) != 3 or self.serial_connection is None:
+			return None
+		if self.commanded_position is None or self._may_be_moving:
+			distance = np.full(3, 2*self.position_max_micrometers)
+		else:
+			distance = np.abs(d - self.commanded_position)
+		moving = (speeds > 0) & (distance > 0)
+		t_move = np.max(distance[moving] / speeds[moving]) if np.any(moving) else 0.0
+		return 1.2*t_move + (self.serial_connection.answer_timeout or 0)
+
+	def _track_stop(self, command_name):
+		"""
+		Forget the tracked position after a command that stops the motors where they are (C003, C004, C005, C008),
+		also when it is sent as a raw code or string.
+		"""
+		if type(command_name) == str:
+			command_name = command_name.strip().upper()[:4]
+		if command_name in _stopping_commands:
+			self.commanded_position = None
+			self.last_move = None
+			self._may_be_moving = False
+
+	def _command_bytes(self, command_name, *parameters: int):
+		"""
+		Command of call_command_code() encoded for writing (with the terminator).
+
+		Codes without parameters are encoded once and then taken from a cache (at most 999 entries); commands with
+		parameters are formatted to bytes in one step (parameters truncated to integers, like int()). Raw string
+		commands are encoded on every call, so arbitrary strings do not pile up in the cache.
+		"""
+		if type(command_name) != int:
+			return (self._command_string(command_name, *parameters) + self.string_terminator).encode()
+		if not parameters:
+			try:
+				return self._encoded_commands[command_name]
+			except KeyError:
+				encoded = (self._command_string(command_name) + self.string_terminator).encode()
+				self._encoded_commands[command_name] = encoded
+				return encoded
+
+		if not 0 < command_name < 1000:
+			raise ValueError(f"Value {command_name} out of bounds for [1, 999].")
+		try:
+			command_format = self._command_formats[len(parameters)]
+		except KeyError:
+			command_format = b'C%03d' + b' %d' * len(parameters) + self.string_terminator.encode()
+			self._command_formats[len(parameters)] = command_format
+		return command_format % (command_name, *parameters)
+
+	def _command_string(self, command_name, *parameters: int):
+		"""Command string for call_command_code()."""
 		if type(command_name) == str:
 			command_string = command_name
 		elif type(command_name) == int:
@@ -318,35 +477,55 @@ class InjectMan:
 				parameters_str = " " if len(parameters) > 0 else ""
 				parameters_str += " ".join(parameters)
 				
-				logging.debug(f'call_command_code(): code: {command_name} parameters_str: {parameters_str}')
-				
 				# Put it all together
 				command_string = f'{command_name}{parameters_str}'
 				
 			else:
 				raise ValueError(f"Value {command_name} out of bounds for [1, 999].")
-			
-
-		result = self.send_command_serial(command_string)
-		logging.debug(f'in call_command_code:\n\tcommand: {command_string}\n\t anwser: {result}')
-		return result
+		return command_string
 
 	# send command to serial (all other calls use this to send )
 		# if the object is simulated, call the simulate response function.
-	def send_command_serial(self, command_str, wait_for_answer=True):
+	def send_command_serial(self, command_str, wait_for_answer=True, answer_timeout=None):
+		"""
+		command_str: command as str, or as bytes with the terminator (see _command_bytes()).
+		answer_timeout: time in s to wait for the answer, None for the answer_timeout of the connection.
+		"""
 		result = None
+		if type(command_str) == bytes:
+			if not self.is_simulated:
+				with self._command_lock:
+					return self.serial_connection.send_bytes(command_str, wait_for_answer=wait_for_answer,
+															 timeout=answer_timeout)
+			command_str = command_str.decode().strip()
 		if self.is_simulated:
-			logging.debug(f'in send_command_serial(): sending "{command_str}" to simulated.')
+			t_send = time.perf_counter()
 			result = self.simulate_serial_response(command_str)
+			if command_trace.enabled:
+				command_trace.record('simulated', command_str, result, t_send, time.perf_counter())
 		else:
 			# raise NotImplementedError('Currently only simulated usage is supported.')
-			logging.debug(f'in send_command_serial(): sending "{command_str}" to serial on port {self.port}.')
+			# Commands and answers are recorded by the serial connection, see command_trace.py.
 			
 			# TODO: think about wait_for_answer usage. are there cases where it would need to be managed differently?
-			result = self.serial_connection.send_string(command_str, wait_for_answer=wait_for_answer)
+			with self._command_lock:
+				result = self.serial_connection.send_string(command_str, wait_for_answer=wait_for_answer,
+															timeout=answer_timeout)
 			
 		return result
 		
+	async def send_command_serial_async(self, command_str, wait_for_answer=True, answer_timeout=None):
+		"""send_command_serial() for the asyncio connection (see connect_async())."""
+		if type(command_str) == bytes:
+			if not self.is_simulated:
+				return await self.serial_connection.send_bytes(command_str, wait_for_answer=wait_for_answer,
+															   timeout=answer_timeout)
+			command_str = command_str.decode().strip()
+		if self.is_simulated:
+			return self.simulate_serial_response(command_str)
+		return await self.serial_connection.send_string(command_str, wait_for_answer=wait_for_answer,
+														timeout=answer_timeout)
+
 	def simulate_serial_response(self, command_str):
 		"""Simulate serial response for debugging purposes.
 		
@@ -365,37 +544,38 @@ class InjectMan:
 	# ---------------------------------------------------------
 	# ### Math functions:
 	
+	def set_calibration(self, d1_calib, d3_calib, z_calib):
+		"""
+		Set the angle of the third motor from a calibration: moving the third motor by d3_calib moves the tip by
+		d1_calib along the first motor and by z_calib in z.
+		"""
+		self.calibration = {'d1_calib': d1_calib, 'd3_calib': d3_calib, 'z_calib': z_calib}
+		self.sin_theta = d1_calib / d3_calib
+		self.cos_theta = z_calib / d3_calib
+		
+		# p = d @ d2p_matrix.T and d = p @ p2d_matrix.T
+		self.d2p_matrix = np.array([[1, 0, -self.sin_theta],
+									[0, 1, 0],
+									[0, 0, self.cos_theta]])
+		self.p2d_matrix = np.linalg.inv(self.d2p_matrix)
+	
 	def _d2p(self, d):
 		"""
 		Compute 3D position p (x, y, z) from motor positions d
 
-		:param d: [d1, d2, d3] are the motor position values
-		:return: p [x, y, z] 3D position in inject man coordinate frame (z facing down)
+		:param d: [d1, d2, d3] are the motor position values, or an (N, 3) array of them
+		:return: p [x, y, z] 3D position in inject man coordinate frame (z facing down), (N, 3) array for (N, 3) d
 		"""
-		d1, d2, d3 = d
-		
-		x = d1 - d3 * self.sin_theta
-		y = d2
-		z = d3 * self.cos_theta
-		
-		p = x, y, z
-		return p
+		return np.asarray(d, dtype=float) @ self.d2p_matrix.T
 	
 	def _p2d(self, p):
 		"""
 		Compute motor positions d from 3D position p (x, y, z)
 
-		:param p: [x, y, z] 3D position inject man coordinate frame (z facing down)
-		:return: [d1, d2, d3] the motor position values
+		:param p: [x, y, z] 3D position inject man coordinate frame (z facing down), or an (N, 3) array of them
+		:return: [d1, d2, d3] the motor position values, (N, 3) array for (N, 3) p
 		"""
-		x, y, z = p
-		
-		d3 = z / self.cos_theta
-		d1 = x + d3 * self.sin_theta
-		d2 = y
-		
-		d = d1, d2, d3
-		return d
+		return np.asarray(p, dtype=float) @ self.p2d_matrix.T
 	
 	# ---------------------------------------------------------
 	# ### High level functions:
@@ -404,34 +584,178 @@ class InjectMan:
 		'''
 		Move to a position in 3D (x, y, z) space.
 		
-		The function takes care of computation the right motor positions.
+		The function takes care of computation the right motor positions. The motor speeds are set so that all
+		the motors arrive at the same time (straight movement), see _synchronized_speeds().
 		
 		:param p: position [x, y, z] to move to
-		:param v: speed of the movement (at the moment one value is used for all 3 axes)
+		:param v: speed of the movement (of the motor with the longest way; the others move slower)
 		:param wait_for_completion: sets to wait for the complete message, or to call the function that
 						moves the inject man without "complete" message
 		:return: reply from injectman
 		'''
 		
-		v = v if v is not None else self.default_speed
+		start = self._start_position()
+		command_code, parameters = self._move_to_command(p, v, wait_for_completion, start)
+		t_send = time.perf_counter()
+		answer = self.call_command_code(command_code, *parameters)
+		self._track_goto(parameters[:3], answer, parameters[3:], t_send)
+		return answer
+	
+	async def move_to_async(self, p, v=None, wait_for_completion=True):
+		"""move_to() for the asyncio connection (see connect_async())."""
+		start = self.commanded_position
+		if start is None or self._may_be_moving:
+			position, _ = self._parse_position_query(await self.call_command_code_async(10))
+			start = self._start_from_query(position)
+		command_code, parameters = self._move_to_command(p, v, wait_for_completion, start)
+		t_send = time.perf_counter()
+		answer = await self.call_command_code_async(command_code, *parameters)
+		self._track_goto(parameters[:3], answer, parameters[3:], t_send)
+		return answer
+	
+	def _move_to_command(self, p, v, wait_for_completion, start=None):
+		"""
+		Command code and parameters (validated) of the GOTO command for move_to().
 		
-		# TODO: scale the speed values so that all motors start and stop synchronous (maybe add an option for that?)
-		vs = [v for i in range(3)]
+		With the motor position start (where the motors are, not only where they were sent) the speeds are
+		synchronized, otherwise all the motors get v. A motor that does not have to move gets v as well, not 0
+		(which would leave it where it is, also if it is still on the way of an earlier GOTO).
+		"""
+		v = v if v is not None else self.default_speed
 		
-		d = self._p2d(p)
+		# Positions are sent as integers (truncated)
+		d = np.trunc(self._p2d(p))
 		
-		if wait_for_completion:
-			r = self.GOTO_position_in_micrometers(*d, *vs)
+		if start is None:
+			vs = [v for i in range(3)]
 		else:
-			r = self.GOTO_position_in_micrometers_NB(*d, *vs)
+			speeds = self._synchronized_speeds(d - start, v)
+			vs = np.where(speeds > 0, speeds, min(abs(v), self.speed_max_micrometers)).tolist()
+		d = d.tolist()
+		
+		self._validate_parameters_range(d, -self.position_max_micrometers, self.position_max_micrometers)
+		self._validate_parameters_range(vs, -self.speed_max_micrometers, self.speed_max_micrometers)
+		
+		# GOTO_position_in_micrometers (7) or GOTO_position_in_micrometers_NB (12)
+		command_code = 7 if wait_for_completion else 12
+		return command_code, d + vs
+	
+	def _synchronized_speeds(self, distance, v):
+		"""
+		Motor speeds for moving the motors by distance ([d1, d2, d3] or (N, 3) for N moves) so that they all arrive
+		at the same time, as fast as allowed: the motor with the longest way moves with v (at most
+		speed_max_micrometers), the others proportionally slower. Motors that do not move get speed 0.
 		
-		return r
+		The speeds are integers; a motor that moves gets at least 1 micrometer/s.
+		"""
+		distance = np.abs(np.asarray(distance, dtype=float))
+		v = min(abs(v), self.speed_max_micrometers)
+		longest = distance.max(axis=-1, keepdims=True)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			speeds = np.where(distance > 0, np.maximum(1, np.round(v * distance / longest)), 0)
+		return speeds
+	
+	def _start_position(self):
+		"""
+		Motor position the next movement starts from: the commanded one, or queried if it is not known or a non
+		blocking GOTO may still be running.
+		"""
+		if self.commanded_position is None or self._may_be_moving:
+			position, _ = self.position_query_in_micrometers()
+			return self._start_from_query(position)
+		return self.commanded_position
+	
+	def _start_from_query(self, position):
+		"""_start_position() from a queried position."""
+		position = np.array(position, dtype=float)
+		if self.commanded_position is None:
+			self.commanded_position = position.copy()
+		elif np.array_equal(position, self.commanded_position):
+			# Arrived, the commanded position is the position again.
+			self._may_be_moving = False
+		return position
+	
+	def _track_goto(self, d, answer, speeds=None, t_send=None):
+		"""
+		Remember the target of a GOTO as the commanded position, if the InjectMan accepted it, and the movement
+		(for the estimates of position_service.py).
+		"""
+		answer = answer.split(' ') if type(answer) == str else []
+		# A007 with limit switches other than 0: stopped at a limit switch, not at the target.
+		if not answer or not answer[0][:1] in 'aA' or (answer[0][1:] == '007' and len(answer) == 2 and answer[1] != '0'):
+			self.commanded_position = None
+			self.last_move = None
+			return
+		target = np.trunc(np.array(d, dtype=float))
+		if speeds is not None and t_send is not None:
+			self.last_move = Move(t_send, self.commanded_position, target, np.abs(np.array(speeds, dtype=float)))
+		self.commanded_position = target
+		# A007 comes when the motors have stopped, A012 right away.
+		self._may_be_moving = answer[0][1:] != '007'
+	
+	def follow_path(self, path, v=None, lookahead=0.05, poll_interval=0.01, wait=True):
+		'''
+		Move through the positions of a path without stopping at the points in between.
+		
+		The GOTO commands of all the points are computed (vectorized _p2d()) and encoded at the start and sent as
+		non blocking GOTO (C012) by a background thread that follows the progress; see path_follower.py.
+		
+		:param path: (N, 3) array of positions [x, y, z]
+		:param v: speed of the movement (of the motor with the longest way in each segment, see move_to())
+		:param lookahead: time in s before reaching a point at which the next one is sent
+		:param poll_interval: time in s between the position queries of the background thread
+		:param wait: wait until the last point is reached; otherwise return right away
+		:return: PathFollower with the progress (index, position, history(), duration) and stop() / wait()
+		'''
+		v = v if v is not None else self.default_speed
+		
+		d_path = self._p2d(np.asarray(path, dtype=float).reshape(-1, 3))
+		# Every segment straight: synchronized speeds from the previous point
+		start = self._start_position()
+		speeds = self._synchronized_speeds(np.diff(np.trunc(d_path), axis=0, prepend=[start]), v)
+		# The next point is sent before the last one is reached, so an axis that does not move in a segment may
+		# still have to finish the previous one: it keeps its last speed instead of 0 (which would stop it).
+		last_moving = np.maximum.accumulate(np.where(speeds > 0, np.arange(len(speeds))[:, None], 0), axis=0)
+		speeds = speeds[last_moving, np.arange(3)]
+		# Axes that have not moved yet get v (see _move_to_command()).
+		speeds[speeds == 0] = min(abs(v), self.speed_max_micrometers)
+		
+		outside = np.abs(d_path) > self.position_max_micrometers
+		if np.any(outside):
+			raise ValueError(f"""Point {np.argmax(np.any(outside, axis=1))} of the path is outside of the valid range [{-self.position_max_micrometers}, {self.position_max_micrometers}].
+							 \r Motor positions: {d_path[np.any(outside, axis=1)][0]}""")
+		self._validate_parameters_range(v, -self.speed_max_micrometers, self.speed_max_micrometers)
+		
+		follower = PathFollower(self, d_path, speeds, lookahead=lookahead, poll_interval=poll_interval).start()
+		if wait:
+			follower.wait()
+		return follower
 	
-	def move_for(self):
-		# TODO: Implementation
-		# TODO: decide if we query current position everytime or store the "supposed" possition in python
-		pass
-		raise NotImplementedError("move_for not yet implemented.")
+	def move_for(self, dp, v=None, wait_for_completion=True):
+		'''
+		Move by dp = [dx, dy, dz] from the position the InjectMan was last sent to.
+		
+		The position is not queried before every move: it is tracked from the sent GOTO commands (it is only
+		queried when it is not known, for example after STOP or manual control).
+		
+		:param dp: relative movement [dx, dy, dz]
+		:param v: speed of the movement (see move_to())
+		:param wait_for_completion: see move_to()
+		:return: reply from injectman
+		'''
+		self._start_position()
+		p = self._d2p(self.commanded_position) + np.asarray(dp, dtype=float)
+		return self.move_to(p, v, wait_for_completion)
+
+	def start_position_service(self, rate=20, history_size=10000):
+		'''
+		Query the position in the background and answer position reads from memory; see position_service.py.
+
+		:param rate: position queries per s
+		:param history_size: number of queried positions kept
+		:return: the running PositionService (position(max_age), position_xyz(max_age), history(), stop())
+		'''
+		return PositionService(self, rate=rate, history_size=history_size).start()
 
 	
 
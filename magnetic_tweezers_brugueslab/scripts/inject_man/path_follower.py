@@ -0,0 +1,182 @@
+'''
+Moving InjectMan along a path of points without stopping at every point (see InjectMan.follow_path()).
+
+All the GOTO commands are computed and encoded before the start. They are sent with the non blocking GOTO (C012),
+so the InjectMan answers right away and the next one can be sent while the motors still move. A background thread
+sends the next point when the current one is about to be reached (lookahead before the arrival expected from the
+speeds), so the motors go on to the next point instead of stopping. Between the points it queries the position (C010)
+to correct the expected arrival and to follow the progress. Because of that the corners of the path are rounded, by at most
+lookahead * speed.
+
+Do not send other commands to the InjectMan while a path is followed (the position queries use the same connection).
+'''
+
+import time
+import logging
+import threading
+
+import numpy as np
+
+from position_service import Move
+
+
+class PathFollower:
+	def __init__(self,
+				 injectman,
+				 d_path,
+				 speeds,
+				 lookahead=0.05,
+				 poll_interval=0.01,
+				 tolerance=2
+				 ) -> None:
+		"""
+		Use InjectMan.follow_path() instead of making this directly.
+
+		:param injectman: the InjectMan (not simulated, remote control active)
+		:param d_path: (N, 3) motor positions of the points, in micrometers
+		:param speeds: (N, 3) motor speeds of the segments to the points, in micrometers/s
+		:param lookahead: the next point is sent when the current one will be reached in less than lookahead s
+		:param poll_interval: maximal time in s between two position queries (on top of the query itself)
+		:param tolerance: distance in micrometers (on every motor) at which the last point counts as reached
+		"""
+		self.injectman = injectman
+		self.d_path = np.asarray(d_path, dtype=float)
+		self.speeds = np.asarray(speeds, dtype=float)
+		self.lookahead = lookahead
+		self.poll_interval = poll_interval
+		self.tolerance = tolerance
+
+		# Encoded before the start, so sending a point costs only the write.
+		self._commands = [injectman._command_bytes(12, *d, *v) for d, v in zip(self.d_path, self.speeds)]
+		# Positions are sent truncated to integers (see InjectMan._command_bytes()).
+		self._targets = np.trunc(self.d_path)
+
+		self.index = -1	# point the motors are moving to
+		self.position = None	# last queried motor position [d1, d2, d3]
+		self.done = threading.Event()
+		self.error = None
+		self._history = []	# (t, index, d1, d2, d3)
+		self._stop = threading.Event()
+		self._thread = None
+		self.t_start = None
+		self.t_end = None
+
+	def start(self):
+		self.t_start = time.perf_counter()
+		self._thread = threading.Thread(target=self._run, name='injectman_path', daemon=True)
+		self._thread.start()
+		return self
+
+	def wait(self, timeout=None):
+		"""Wait until the last point is reached (or the path was stopped). Returns True if done."""
+		finished = self.done.wait(timeout)
+		if self.error is not None:
+			raise self.error
+		return finished
+
+	def stop(self):
+		"""Stop the motors (C008) and the path."""
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+
+	def history(self):
+		"""Queried positions as an array with the columns t (s since the start), index of the point, d1, d2, d3."""
+		return np.array(self._history).reshape(-1, 5)
+
+	@property
+	def duration(self):
+		if self.t_end is None:
+			return None
+		return self.t_end - self.t_start
+
+	def _run(self):
+		injectman = self.injectman
+		last = len(self._commands) - 1
+		reply = np.zeros(4, dtype=np.int64)
+		try:
+			if injectman.is_simulated:
+				# Nothing moves, the commands are only sent.
+				while self.index < last:
+					self._send_next(None)
+				injectman.commanded_position = self._targets[-1].copy()
+			else:
+				t_query = self._query(reply)
+				t_last_move = time.perf_counter()
+				t_arrival = self._send_next(self.position)
+				while not self._stop.is_set():
+					# The next point is sent lookahead before the expected arrival, which is computed from the
+					# speeds and corrected with the queried positions.
+					t_send = t_arrival - self.lookahead
+					if self.index < last:
+						if time.perf_counter() >= t_send:
+							t_arrival = self._send_next(self._targets[self.index])
+							continue
+						if t_send - time.perf_counter() < t_query:
+							# No time for a query before the next point is due.
+							time.sleep(max(0, t_send - time.perf_counter()))
+							continue
+
+					previous = self.position
+					t_query = self._query(reply)
+					now = time.perf_counter()
+					if np.any(self.position != previous):
+						t_last_move = now
+					remaining = np.abs(self._targets[self.index] - self.position)
+					if self.index == last and np.all(remaining <= self.tolerance):
+						break
+					if now - t_last_move > 1.0:
+						# Not moving any more, but not at the point (limit switch?)
+						logging.warning(f'InjectMan stopped at {self.position}, {remaining} away from point {self.index}. Limit switches: {reply[3]}')
+						break
+					t_arrival = now + self._time_to_reach(remaining, self.speeds[self.index])
+					if self.index < last:
+						time.sleep(min(self.poll_interval, max(0, t_arrival - self.lookahead - now)))
+					else:
+						time.sleep(self.poll_interval)
+				if self._stop.is_set():
+					injectman.STOP()
+				elif np.all(np.abs(self._targets[-1] - self.position) <= self.tolerance):
+					injectman.commanded_position = self._targets[-1].copy()
+					injectman._may_be_moving = bool(np.any(self._targets[-1] != self.position))
+				else:
+					injectman.commanded_position = None
+		except Exception as e:
+			self.error = e
+			# The motors may still follow the last accepted point.
+			try:
+				injectman.STOP()
+			except Exception as stop_error:
+				logging.error(f'STOP after the path follower failed: {stop_error!r}')
+			injectman.commanded_position = None
+		self.t_end = time.perf_counter()
+		self.done.set()
+
+	def _query(self, reply):
+		"""Query the position into reply and self.position. Returns the time the query took."""
+		t = time.perf_counter()
+		self.injectman.position_query_array(reply)
+		now = time.perf_counter()
+		self.position = reply[:3].copy()
+		self._history.append((now - self.t_start, self.index, *self.position))
+		return now - t
+
+	def _send_next(self, start):
+		"""Send the next point. Returns the time it is expected to be reached, moving from start."""
+		self.index += 1
+		t_send = time.perf_counter()
+		answer = self.injectman.send_command_serial(self._commands[self.index])
+		if type(answer) != str or not answer.upper().startswith('A012'):
+			raise RuntimeError(f'InjectMan did not accept point {self.index} of the path: {answer}')
+		self.injectman._may_be_moving = not self.injectman.is_simulated
+		self.injectman.last_move = Move(t_send, start, self._targets[self.index], self.speeds[self.index])
+		if start is None:
+			return time.perf_counter()
+		return time.perf_counter() + self._time_to_reach(np.abs(self._targets[self.index] - start), self.speeds[self.index])
+
+	@staticmethod
+	def _time_to_reach(remaining, speeds):
+		moving = speeds > 0
+		if not np.any(moving):
+			return 0
+		return np.max(remaining[moving] / speeds[moving])
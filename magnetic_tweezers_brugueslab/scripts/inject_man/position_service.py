@@ -0,0 +1,152 @@
+'''
+Position of InjectMan without a serial round trip for every read (see InjectMan.start_position_service()).
+
+A background thread queries the position (C010) at a fixed rate and keeps the replies with their time in a ring
+buffer. Reads are answered from memory: the last queried position, moved on along the last GOTO command sent since
+(dead reckoning with the motor speeds, the same way the motors move). The caller can bound the age of the last
+query; if it is older, the position is queried right away.
+
+    service = im.start_position_service(rate=20)
+    d = service.position()                  # motor positions [d1, d2, d3], estimated for now
+    p = service.position_xyz(max_age=0.05)  # [x, y, z], queried if the last query is older than 50 ms
+    t, d, limit_switches = service.history()
+    service.stop()
+'''
+
+import time
+import logging
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+
+# A GOTO command: time it was sent (time.perf_counter()), start and target motor positions (start None if not known)
+# and motor speeds.
+Move = namedtuple('Move', ['t', 'start', 'target', 'speeds'])
+
+
+class PositionService:
+	def __init__(self,
+				 injectman,
+				 rate=20,
+				 history_size=10000
+				 ) -> None:
+		"""
+		:param injectman: the InjectMan
+		:param rate: position queries per s
+		:param history_size: number of queried positions kept (the oldest are overwritten)
+		"""
+		self.injectman = injectman
+		self.rate = rate
+		self.history_size = history_size
+
+		# Ring buffer of the queries: time (time.perf_counter()), d1, d2, d3, limit switches
+		self._t = np.zeros(history_size)
+		self._d = np.zeros((history_size, 3))
+		self._limit_switches = np.zeros(history_size, dtype=np.int64)
+		self._n = 0	# number of queries so far (the next one goes to _n % history_size)
+		self._lock = threading.Lock()
+
+		self._stop = threading.Event()
+		self._thread = None
+
+	def start(self):
+		self._stop.clear()
+		self._thread = threading.Thread(target=self._run, name='injectman_position', daemon=True)
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc):
+		self.stop()
+
+	# ------------------------------------------------------------------------------
+	# Reads
+
+	def position(self, max_age=None, estimate=True):
+		"""
+		Motor positions [d1, d2, d3] in micrometers.
+
+		:param max_age: if the last query is older than max_age s (or there was none), query now
+		:param estimate: move the queried position on along the last GOTO to now (dead reckoning)
+		"""
+		if self._n == 0 or (max_age is not None and self.age() > max_age):
+			self.query()
+		with self._lock:
+			i = (self._n - 1) % self.history_size
+			t_query, d = self._t[i], self._d[i].copy()
+		if estimate:
+			d = self._dead_reckoning(d, t_query, time.perf_counter())
+		return d
+
+	def position_xyz(self, max_age=None, estimate=True):
+		"""position() as [x, y, z] (see InjectMan._d2p())."""
+		return self.injectman._d2p(self.position(max_age, estimate))
+
+	def limit_switches(self, max_age=None):
+		"""Limit switches of the last query (see InjectMan.position_query_in_micrometers())."""
+		if self._n == 0 or (max_age is not None and self.age() > max_age):
+			self.query()
+		return int(self._limit_switches[(self._n - 1) % self.history_size])
+
+	def age(self):
+		"""Time in s since the last query (inf if there was none)."""
+		if self._n == 0:
+			return np.inf
+		return time.perf_counter() - self._t[(self._n - 1) % self.history_size]
+
+	def history(self):
+		"""Queried positions, oldest first: times (time.perf_counter()), (N, 3) motor positions, limit switches."""
+		with self._lock:
+			n = min(self._n, self.history_size)
+			order = (np.arange(self._n - n, self._n)) % self.history_size
+			return self._t[order], self._d[order], self._limit_switches[order]
+
+	def query(self):
+		"""Query the position now and add it to the history."""
+		reply = self.injectman.position_query_array(np.zeros(4, dtype=np.int64))
+		t = time.perf_counter()
+		with self._lock:
+			i = self._n % self.history_size
+			self._t[i] = t
+			self._d[i] = reply[:3]
+			self._limit_switches[i] = reply[3]
+			self._n += 1
+
+	# ------------------------------------------------------------------------------
+
+	def _dead_reckoning(self, d, t_query, t):
+		"""Position at t, from the position d queried at t_query and the last GOTO sent."""
+		move = self.injectman.last_move
+		if move is None:
+			return d
+		if move.t > t_query:
+			# The GOTO was sent after the query: it starts at its start (or where the query saw the motors).
+			start, t_start = (move.start, move.t) if move.start is not None else (d, move.t)
+		else:
+			start, t_start = d, t_query
+		distance = move.target - start
+		travelled = np.minimum(np.abs(distance), move.speeds * max(0.0, t - t_start))
+		return start + np.sign(distance) * travelled
+
+	def _run(self):
+		interval = 1 / self.rate
+		t_next = time.perf_counter()
+		while not self._stop.is_set():
+			try:
+				self.query()
+			except Exception as e:
+				logging.warning(f'Position query failed: {e}')
+			t_next += interval
+			# Behind (for example the port was busy with a blocking GOTO): go on from now.
+			t_next = max(t_next, time.perf_counter())
+			self._stop.wait(t_next - time.perf_counter())
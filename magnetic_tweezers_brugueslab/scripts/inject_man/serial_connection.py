@@ -1,34 +1,260 @@
 import logging
 import time
 import serial
+import threading
+import queue
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+
+import command_trace
+
+try:
+	import binary_protocol
+except ImportError:
+	# The binary protocol is only used (and available) for the voltage control Arduino.
+	binary_protocol = None
+
+
+class lineFramer:
+	def __init__(self, capacity=4096, terminator=b'\n') -> None:
+		"""
+		Splits the bytes received from a port into lines, without copying the buffer for every line.
+
+		The bytes are read into a preallocated bytearray; complete lines are found with one pass over the new
+		bytes and handed out together. Consumed bytes are only dropped (by moving the rest to the front) when the
+		end of the buffer is reached, and the buffer grows only if a single line does not fit.
+
+		:param capacity: initial size of the buffer in bytes
+		:param terminator: end of a line (single byte)
+		"""
+		self.terminator = terminator
+		self._buf = bytearray(capacity)
+		self._view = memoryview(self._buf)
+		self._start = 0	# first byte not handed out yet
+		self._scan = 0	# first byte not searched for the terminator yet
+		self._end = 0	# end of the received bytes
+
+	def fill(self, port):
+		"""Read everything waiting on port (at least 1 byte, blocking up to the port timeout) in one read. Returns the number of bytes read."""
+		n_wanted = max(1, port.in_waiting)
+		self._make_room(n_wanted)
+		target = self._view[self._end:self._end + n_wanted]
+		readinto = getattr(port, 'readinto', None)
+		if readinto is not None:
+			n_read = readinto(target) or 0
+		else:
+			data = port.read(n_wanted)
+			n_read = len(data)
+			target[:n_read] = data
+		self._end += n_read
+		return n_read
+
+	def take_lines(self, copy=True):
+		"""
+		Return all complete lines (with the terminator) and consume them.
+
+		With copy=False the lines are memoryviews into the buffer, which are only valid until the next fill()
+		(decode them with str(line, 'ascii') or bytes(line)).
+		"""
+		lines = []
+		buf, start, end = self._buf, self._start, self._end
+		i = buf.find(self.terminator, self._scan, end)
+		while i >= 0:
+			lines.append(bytes(self._view[start:i+1]) if copy else self._view[start:i+1])
+			start = i + 1
+			i = buf.find(self.terminator, start, end)
+		self._start = start
+		self._scan = end
+		if start == end:
+			self._start = self._scan = self._end = 0
+		return lines
+
+	def clear(self):
+		"""Discard everything. Returns the number of discarded bytes."""
+		n_bytes = self._end - self._start
+		self._start = self._scan = self._end = 0
+		return n_bytes
+
+	def __len__(self):
+		return self._end - self._start
+
+	def _make_room(self, n_bytes):
+		if len(self._buf) - self._end >= n_bytes:
+			return
+		n_kept = self._end - self._start
+		if n_kept + n_bytes <= len(self._buf):
+			# Move the incomplete line to the front (same size, so views handed out before stay valid objects).
+			self._buf[:n_kept] = self._view[self._start:self._end]
+		else:
+			buf = bytearray(max(2*len(self._buf), n_kept + n_bytes))
+			buf[:n_kept] = self._view[self._start:self._end]
+			self._buf, self._view = buf, memoryview(buf)
+		self._scan -= self._start
+		self._start, self._end = 0, n_kept
 
 
 class serialConnection:
 	def __init__(self, 
 				 port,
 				 baud_rate=9600,
-				 string_terminator = '\n'
+				 string_terminator = '\n',
+				 use_reader_thread=False,
+				 answer_timeout=1.0,
+				 protocol='ascii',
+				 serial_port=None,
+				 reset_on_open=True,
+				 ready_answer=None,
+				 ready_probe=None,
+				 ready_timeout=3.0
 				) -> None:
+		"""
+		Serial connection to a device that answers with lines (Arduino, InjectMan).
+
+		:param use_reader_thread: if True, a background thread blocks on the port and hands complete lines to
+						the callers waiting in send_string(), instead of send_string() polling in_waiting.
+		:param answer_timeout: maximal time in s to wait for an answer (in the polling mode only in send_strings()
+						and send_frames()).
+		:param protocol: 'ascii' (lines, send_string()) or 'binary' (fixed size frames, send_frames(),
+						see binary_protocol.py).
+		:param serial_port: already opened port object to use instead of opening port (for example
+						binary_protocol.LoopbackSerial()).
+		:param reset_on_open: if False, the port is opened without toggling DTR, so an Arduino does not reset (where
+						the OS allows it).
+		:param ready_answer: start of the line that tells that the device is ready (boot banner or answer to
+						ready_probe). Without it, the connection waits ready_timeout after a reset and not at all
+						without one.
+		:param ready_probe: command sent until ready_answer arrives, for devices without a banner.
+		:param ready_timeout: maximal time in s to wait for the device.
+		"""
 		self.port = port
 		self.baud_rate = baud_rate
 		self.string_terminator = string_terminator 
+		self.use_reader_thread = use_reader_thread
+		self.answer_timeout = answer_timeout
+		self.protocol = protocol
+
+		if protocol == 'binary' and binary_protocol is None:
+			raise ValueError('protocol="binary" needs binary_protocol.py (voltage_control folder).')
+		if protocol not in ('ascii', 'binary'):
+			raise ValueError(f'Unknown protocol "{protocol}". Use "ascii" or "binary".')
 
-		self.serial = serial.Serial(self.port, self.baud_rate, timeout=0.1)
-		time.sleep(3)
+		self.buf = bytearray()	# binary protocol (polling mode)
+		self._framer = lineFramer()
+		self._lines = deque()	# received lines not returned by readline() yet (polling mode)
+
+		# Reader thread mode: futures of the callers waiting for an answer (in the order of the sent commands) and
+		# a queue for lines nobody was waiting for (read with readline()).
+		self._pending_answers = deque()
+		self._unsolicited_lines = queue.Queue()
+		self._write_lock = threading.Lock()
+		self._reader_stop = threading.Event()
+		self._reader_thread = None
+
+		if serial_port is not None:
+			self.serial = serial_port
+		else:
+			self.serial = self._open_port(self.port, self.baud_rate, 0.1, reset=reset_on_open)
+			if ready_answer is not None:
+				self.wait_until_ready(ready_answer, ready_probe, ready_timeout)
+			elif reset_on_open:
+				# Wait for the Arduino bootloader.
+				time.sleep(ready_timeout)
 		logging.info(f'Serial opened on port {self.port} with baud rate {self.baud_rate}')
 
-		self.buf = bytearray()
+		if self.use_reader_thread:
+			self._start_reader_thread()
+
+	@staticmethod
+	def _open_port(port, baud_rate, timeout, reset=True):
+		if reset:
+			return serial.Serial(port, baud_rate, timeout=timeout)
+		s = serial.Serial()
+		s.port = port
+		s.baudrate = baud_rate
+		s.timeout = timeout
+		# Set before opening: the DTR line stays low, which is what resets the Arduino.
+		s.dtr = False
+		s.open()
+		return s
+
+	def wait_until_ready(self, ready_answer, ready_probe=None, timeout=3.0, probe_interval=0.1):
+		"""
+		Read until a line starting with ready_answer arrives, sending ready_probe every probe_interval s if given.
+		Then the input received so far is discarded (see drain()). Returns the time in s it took, or None (and
+		logs a warning) if the device did not get ready within timeout.
+
+		probe_interval has to be longer than the time the device needs to answer the probe, otherwise a late
+		answer can be taken for the answer to the first command.
+		"""
+		t_start = time.perf_counter()
+		deadline = t_start + timeout
+		ready_answer = ready_answer.encode()
+		n_probes, n_answers = 0, 0
+		t_probe = t_start
+		t_ready = t_answer = None
+		while time.perf_counter() < deadline:
+			if ready_probe is not None and t_ready is None and time.perf_counter() >= t_probe:
+				self.serial.write((ready_probe + self.string_terminator).encode())
+				n_probes += 1
+				t_probe = time.perf_counter() + probe_interval
+			self._framer.fill(self.serial)
+			for line in self._framer.take_lines(copy=False):
+				if bytes(line).strip().startswith(ready_answer):
+					n_answers += 1
+					t_answer = time.perf_counter()
+					if t_ready is None:
+						t_ready = t_answer
+			# Answers to the earlier probes may still be on the way (they come probe_interval apart), so they are
+			# waited for and not taken as answers to the first commands.
+			if t_ready is not None and (n_answers >= n_probes or time.perf_counter() > t_answer + 2*probe_interval):
+				break
+
+		self.drain()
+		if t_ready is None:
+			logging.warning(f'No "{ready_answer.decode()}" from {self.port} within {timeout} s, continuing anyway')
+			return None
+		logging.info(f'{self.port} ready after {t_ready - t_start:.3f} s')
+		return t_ready - t_start
 
-	def send_string(self, string_to_send, wait_for_answer=False):
+	def drain(self):
+		"""
+		Discard the input received so far (boot messages, stale answers) in one bulk read. Returns the number of
+		discarded bytes.
+		"""
+		n_bytes = len(self.buf) + self._framer.clear() + sum(len(line) for line in self._lines)
+		del self.buf[:]
+		self._lines.clear()
+		if self._reader_thread is not None:
+			while True:
+				try:
+					n_bytes += len(self._unsolicited_lines.get_nowait())
+				except queue.Empty:
+					break
+			return n_bytes
+		n_waiting = self.serial.in_waiting
+		if n_waiting:
+			n_bytes += len(self.serial.read(n_waiting))
+		return n_bytes
 
+	def send_string(self, string_to_send, wait_for_answer=False, timeout=None):
+		"""timeout: time in s to wait for the answer with the reader thread, instead of answer_timeout (for commands
+		answered only when done, like the blocking GOTO of the InjectMan)."""
 		string_to_send += self.string_terminator
 		encoded_string = str.encode(string_to_send)
+		return self.send_bytes(encoded_string, wait_for_answer, timeout)
 
-		logging.debug(f'In send_string(): Encoded string: {encoded_string}')
+	def send_bytes(self, encoded_string, wait_for_answer=False, timeout=None):
+		"""send_string() for a command that is already encoded, with the terminator (for example from a cache)."""
+		t_send = time.perf_counter()
+
+		if self.use_reader_thread:
+			return self._send_string_threaded(encoded_string, wait_for_answer, t_send, timeout)
 
 		self.serial.write(encoded_string)
 		
 		if not wait_for_answer:
+			if command_trace.enabled:
+				command_trace.record(self.port, encoded_string, None, t_send)
 			return None
 		else:
 			# time.sleep(1)
@@ -38,42 +264,264 @@ class serialConnection:
 			
 			answer_recieved = False
 			while not answer_recieved:
-				if self.serial.in_waiting > 0:
+				if self._lines or self.serial.in_waiting > 0:
 					answer = self.readline()
 					answer_recieved = True
 				
-			
-			logging.debug(f'In send_string(): Raw answer: {answer} type: {type(answer)}')
+			if command_trace.enabled:
+				command_trace.record(self.port, encoded_string, answer, t_send, time.perf_counter())
 			
 			answer_decoded = answer.decode().strip()
-			logging.debug(f'Answer is: {answer}')
-			logging.debug(f'Answer decoded and stripped: "{answer_decoded}"')
 			
 			return answer_decoded
 
-	def readline(self):
-		# print('ReadLine.readline() call. self.buf:', self.buf, self.buf.decode())
-		i = self.buf.find(b"\n")
-		# print('i =', i)
-		if i >= 0:
-			r = self.buf[:i+1]
-			self.buf = self.buf[i+1:]
-			return r
+	def send_strings(self, strings_to_send):
+		"""
+		Send several commands in one write and return their answers (decoded and stripped) in the same order.
+
+		Every command has to produce exactly one answer line. With the reader thread all the commands are in
+		flight at the same time, so a set + sense pair costs one round trip instead of two.
+		"""
+		t_send = time.perf_counter()
+		if self.use_reader_thread:
+			futures = self.submit_strings(strings_to_send)
+			answers = [answer.decode().strip() for answer in self._wait_for_all(futures)]
+			if command_trace.enabled:
+				command_trace.record_batch(self.port, strings_to_send, answers, t_send, time.perf_counter())
+			return answers
+
+		self.serial.write(self._encode_strings(strings_to_send))
+		answers = []
+		t_timeout = time.time() + self.answer_timeout * len(strings_to_send)
+		while len(answers) < len(strings_to_send):
+			answer = self.readline()
+			if len(answer) > 0:
+				answers.append(answer.decode().strip())
+			elif time.time() > t_timeout:
+				raise TimeoutError(f'Got {len(answers)} of {len(strings_to_send)} answers on port {self.port}.')
+		if command_trace.enabled:
+			command_trace.record_batch(self.port, strings_to_send, answers, t_send, time.perf_counter())
+		return answers
+
+	def submit_strings(self, strings_to_send):
+		"""
+		Reader thread mode only: send several commands in one write without waiting.
+
+		Returns a list of futures, one per command, resolved with the raw answer lines in the order of the commands.
+		"""
+		if not self.use_reader_thread:
+			raise RuntimeError('submit_strings() needs the connection to be opened with use_reader_thread=True.')
+		return self._submit(self._encode_strings(strings_to_send), len(strings_to_send))
+
+	def _encode_strings(self, strings_to_send):
+		return ''.join(s + self.string_terminator for s in strings_to_send).encode()
+
+	def send_frames(self, frames):
+		"""
+		Binary protocol: send (command, tip, value) frames in one write and return the answer frames decoded to
+		(command, tip, value), in the same order.
+
+		Raises binary_protocol.FrameError if an answer is corrupted.
+		"""
+		encoded_frames = binary_protocol.encode_frames(frames)
+		t_send = time.perf_counter()
+		if self.use_reader_thread:
+			answers = self._wait_for_all(self._submit(encoded_frames, len(frames)))
+		else:
+			self.serial.write(encoded_frames)
+			answers = [self._read_frame() for _ in frames]
+		answers = [binary_protocol.decode_frame(answer) for answer in answers]
+		if command_trace.enabled:
+			command_trace.record_batch(self.port, frames, answers, t_send, time.perf_counter())
+		return answers
+
+	def _read_frame(self):
+		"""Polling mode: read one (undecoded) frame of the binary protocol."""
+		frame_size = binary_protocol.FRAME_SIZE
+		t_timeout = time.time() + self.answer_timeout
 		while True:
-			i = max(1, min(2048, self.serial.in_waiting))
+			# Drop anything before the sync byte.
+			start = self.buf.find(binary_protocol.SYNC)
+			del self.buf[:start if start >= 0 else len(self.buf)]
+			if len(self.buf) >= frame_size:
+				frame = bytes(self.buf[:frame_size])
+				if binary_protocol.is_valid(frame):
+					del self.buf[:frame_size]
+					return frame
+				# The sync byte may be inside a payload (see binary_protocol.take_frames()): go on from the next byte.
+				binary_protocol.n_bad_frames += 1
+				del self.buf[:1]
+				continue
+
+			data = self.serial.read(frame_size - len(self.buf))
+			if len(data) <= 0 and time.time() > t_timeout:
+				raise TimeoutError(f'No answer frame on port {self.port}.')
+			self.buf.extend(data)
+
+	def close(self):
+		"""Stop the reader thread (if running) and close the port."""
+		self._reader_stop.set()
+		if self._reader_thread is not None:
+			self._reader_thread.join(timeout=1)
+			self._reader_thread = None
+		self.serial.close()
+
+	# ------------------------------------------------------------------------------
+	# Reader thread mode
+
+	def _start_reader_thread(self):
+		self._reader_stop.clear()
+		self._reader_thread = threading.Thread(target=self._reader_loop, name=f'serial_reader_{self.port}', daemon=True)
+		self._reader_thread.start()
+
+	def _reader_loop(self):
+		"""
+		Block on the port and dispatch every complete line (or frame in the binary protocol).
+
+		The line goes to the oldest caller waiting for an answer, or to the queue for readline() if nobody waits.
+		The read blocks for at most the port timeout, so the thread notices close() without spinning.
+		"""
+		framer = lineFramer()
+		buf = bytearray()
+		while not self._reader_stop.is_set():
+			try:
+				if self.protocol == 'ascii':
+					n_read = framer.fill(self.serial)
+				else:
+					data = self.serial.read(max(1, self.serial.in_waiting))
+					buf.extend(data)
+					n_read = len(data)
+			except (OSError, TypeError, AttributeError, serial.SerialException):
+				# Port was closed under us (for example sc.serial.close() in the notebook).
+				break
+			if not n_read:
+				self._drop_expired()
+				continue
+			messages = framer.take_lines() if self.protocol == 'ascii' else binary_protocol.take_frames(buf)
+			for message in messages:
+				self._dispatch_line(message)
+
+		# Nobody will answer the callers still waiting (expired placeholders are already cancelled).
+		while self._pending_answers:
+			future = self._pending_answers.popleft()
+			if not future.done():
+				try:
+					future.set_exception(serial.SerialException(f'Port {self.port} closed.'))
+				except InvalidStateError:
+					# Expired meanwhile.
+					pass
+
+	def _dispatch_line(self, line):
+		try:
+			future = self._pending_answers.popleft()
+		except IndexError:
+			self._unsolicited_lines.put(line)
+			return
+		try:
+			future.set_result(line)
+		except InvalidStateError:
+			# Request that timed out (see _expire()): its late answer is dropped.
+			logging.warning(f'Late answer on port {self.port} dropped: {line}')
+
+	def _send_string_threaded(self, encoded_string, wait_for_answer, t_send, timeout=None):
+		if not wait_for_answer:
+			with self._write_lock:
+				self.serial.write(encoded_string)
+			if command_trace.enabled:
+				command_trace.record(self.port, encoded_string, None, t_send)
+			return None
+
+		answer, = self._wait_for_all(self._submit(encoded_string, 1), timeout)
+		if command_trace.enabled:
+			command_trace.record(self.port, encoded_string, answer, t_send, time.perf_counter())
+		return answer.decode().strip()
+
+	def _submit(self, encoded_data, n_answers):
+		"""Write the data and return the futures of the n_answers answers it produces."""
+		futures = [Future() for _ in range(n_answers)]
+		# The futures have to be registered before the write, otherwise a fast answer could be given to nobody.
+		with self._write_lock:
+			self._pending_answers.extend(futures)
+			self.serial.write(encoded_data)
+		return futures
+
+	def _wait_for_all(self, futures, timeout=None):
+		"""Raw answers of the futures (waiting at most timeout, default answer_timeout, for each). On a timeout all of them expire."""
+		timeout = self.answer_timeout if timeout is None else timeout
+		try:
+			answers = [future.result(timeout=timeout) for future in futures]
+		except TimeoutError:
+			self._expire(futures)
+			raise
+		return answers
 
-			data = self.serial.read(i)
-			if len(data) <= 0:
+	def _expire(self, futures):
+		"""
+		Cancel requests that timed out. They stay in the queue as placeholders, so a late answer is consumed (and
+		dropped) by its own request and not handed to the next caller (see _drop_expired() for answers that never
+		come).
+		"""
+		t_expired = time.perf_counter()
+		for future in futures:
+			if future.cancel():
+				future.t_expired = t_expired
+
+	def _drop_expired(self):
+		"""
+		Reader thread, when nothing arrives: drop the placeholders at the front of the queue that expired more than
+		answer_timeout ago (their answers are taken as lost), so they do not swallow the answers of later requests.
+		Only the reader thread takes futures from the queue, so this does not race with _dispatch_line().
+		"""
+		pending = self._pending_answers
+		now = time.perf_counter()
+		while pending and pending[0].cancelled() and now - pending[0].t_expired > self.answer_timeout:
+			pending.popleft()
+
+	def readline(self):
+		if self.use_reader_thread:
+			# Lines not claimed by send_string(). Returns '' on timeout, the same as the polling readline.
+			try:
+				return self._unsolicited_lines.get(timeout=self.serial.timeout)
+			except queue.Empty:
 				return ''
-			
-			i = data.find(b"\n")
-			if i >= 0:
-				r = self.buf + data[:i+1]
-				self.buf[0:] = data[i+1:]
-				return r
-			else:
-				self.buf.extend(data)
-	
+
+		# All the lines of a read are split at once; the next calls return them without reading.
+		while not self._lines:
+			if self._framer.fill(self.serial) <= 0:
+				return ''
+			self._lines.extend(self._framer.take_lines())
+		return self._lines.popleft()
+
+	def readlines(self):
+		"""
+		All the complete lines received so far (at least one, if one arrives within the port timeout), as a list.
+		Cheaper than calling readline() for every line when many lines arrive at once.
+
+		In the polling mode the lines of the read are memoryviews into the receive buffer, not copies: they are
+		only valid until the next read on the connection (readline(), readlines(), send_string() with an answer).
+		Decode them right away, with str(line, 'ascii'). With the reader thread the lines are bytes, because they
+		are handed over from the reader thread, which reuses its buffer.
+		"""
+		if self.use_reader_thread:
+			lines = [self.readline()]
+			if not lines[0]:
+				return []
+			while True:
+				try:
+					lines.append(self._unsolicited_lines.get_nowait())
+				except queue.Empty:
+					return lines
+
+		# Lines split earlier for readline() (copies), or the lines of one read (everything waiting) without copying.
+		# Not a second read after that: it may move the buffer under the views.
+		lines = list(self._lines)
+		self._lines.clear()
+		while not lines:
+			if self._framer.fill(self.serial) <= 0:
+				break
+			lines = self._framer.take_lines(copy=False)
+		return lines
+
 	def readline_normal(self):
 		print('using the "normal" readline')
 		return self.serial.readline()
@@ -84,6 +532,3 @@ class serialConnection:
 		to see where the bahaviour comes from. my code or somehwere else.
 		
 		Tested in the lab on the injectman and no such problem could be found."""
-	
-
-	
\ No newline at end of file
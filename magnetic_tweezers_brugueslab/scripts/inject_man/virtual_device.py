@@ -0,0 +1,149 @@
+'''
+Base class for virtual serial devices on a pseudo terminal (Linux and macOS), for running and benchmarking the code
+without the lab hardware.
+
+The device opens a pty pair and answers on the master side in a background thread. Its port (the slave side, for
+example /dev/pts/3) is opened by serialConnection like any other port:
+
+    device = VirtualArduino().start()
+    sc = serialConnection(port=device.port, baud_rate=19200, string_terminator='\r')
+
+The transport can be made realistic: the time the bytes need on the wire at a given baud rate, a processing latency
+of the device and dropped or garbled bytes.
+'''
+
+import os
+import time
+import random
+import select
+import threading
+
+
+class VirtualDevice:
+	def __init__(self,
+				 baud_rate=None,
+				 latency=0.0,
+				 drop_rate=0.0,
+				 garble_rate=0.0,
+				 seed=None
+				 ) -> None:
+		"""
+		:param baud_rate: if given, reading and writing takes as long as on a real line (10 bits per byte)
+		:param latency: processing time in s of the device for every command
+		:param drop_rate: probability that a byte of an answer is lost
+		:param garble_rate: probability that a byte of an answer is replaced with a random byte
+		:param seed: seed of the random generator for the noise, drops and garbling
+		"""
+		self.baud_rate = baud_rate
+		self.latency = latency
+		self.drop_rate = drop_rate
+		self.garble_rate = garble_rate
+		self.random = random.Random(seed)
+
+		self.port = None
+		self.n_commands = 0
+		self._master = None
+		self._slave = None
+		self._stop = threading.Event()
+		self._thread = None
+
+	def start(self):
+		"""Open the pty and start answering. Returns the device (its port is in device.port)."""
+		import pty
+		import tty
+
+		self._master, self._slave = pty.openpty()
+		# Raw mode: no echo and no translation of line endings on the pty.
+		tty.setraw(self._slave)
+		self.port = os.ttyname(self._slave)
+		self._stop.clear()
+		self._thread = threading.Thread(target=self._run, name=f'{type(self).__name__}_{self.port}', daemon=True)
+		self._thread.start()
+		self.on_start()
+		return self
+
+	def stop(self):
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join(timeout=1)
+			self._thread = None
+		for fd in (self._master, self._slave):
+			if fd is not None:
+				os.close(fd)
+		self._master = self._slave = None
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc):
+		self.stop()
+
+	# ------------------------------------------------------------------------------
+	# To be implemented by the devices
+
+	def on_start(self):
+		"""Called after the port is open (for example to send a boot banner with write())."""
+		pass
+
+	def take_commands(self, buf: bytearray) -> list:
+		"""Remove the complete commands from buf and return them. Default: lines ending with '\\r' or '\\n'."""
+		commands = []
+		while True:
+			i_r, i_n = buf.find(b'\r'), buf.find(b'\n')
+			i = min(i for i in (i_r, i_n, len(buf)) if i >= 0)
+			if i == len(buf):
+				return commands
+			command = bytes(buf[:i])
+			del buf[:i+1]
+			if command:
+				commands.append(command)
+
+	def handle_command(self, command: bytes):
+		"""Answer (bytes, with the line terminator) to a command, or None if the device does not answer."""
+		raise NotImplementedError
+
+	# ------------------------------------------------------------------------------
+
+	def write(self, data: bytes):
+		"""Send data to the host (with the emulated transport)."""
+		data = self._corrupt(data)
+		if self.baud_rate:
+			time.sleep(10 * len(data) / self.baud_rate)
+		try:
+			os.write(self._master, data)
+		except OSError:
+			pass
+
+	def _corrupt(self, data: bytes) -> bytes:
+		if not self.drop_rate and not self.garble_rate:
+			return data
+		out = bytearray()
+		for byte in data:
+			r = self.random.random()
+			if r < self.drop_rate:
+				continue
+			if r < self.drop_rate + self.garble_rate:
+				byte = self.random.randrange(256)
+			out.append(byte)
+		return bytes(out)
+
+	def _run(self):
+		buf = bytearray()
+		while not self._stop.is_set():
+			readable, _, _ = select.select([self._master], [], [], 0.05)
+			if not readable:
+				continue
+			try:
+				data = os.read(self._master, 4096)
+			except OSError:
+				return
+			if self.baud_rate:
+				time.sleep(10 * len(data) / self.baud_rate)
+			buf.extend(data)
+			for command in self.take_commands(buf):
+				self.n_commands += 1
+				if self.latency:
+					time.sleep(self.latency)
+				answer = self.handle_command(command)
+				if answer:
+					self.write(answer)
@@ -0,0 +1,120 @@
+'''
+Virtual InjectMan on a pseudo terminal (see virtual_device.py), speaking the C0xx commands of the Cell Technology
+PC Control manual that are used by inject_man.py:
+
+    C001                    -> A001 <version>
+    C003                    reset: stop, position 0,0,0                     -> A003
+    C004 / C005             remote / manual control                         -> A004 / A005
+    C007 px py pz vx vy vz  GOTO, answers when the motors have stopped      -> A007 <limit switches>
+    C008                    STOP                                            -> A008
+    C010                    position query (motor coordinates)              -> A010 d1 d2 d3 <limit switches>
+    C012 px py pz vx vy vz  GOTO non blocking, answers right away           -> A012
+    C014 n / C015 n         short / long acoustic signals                   -> A014 / A015
+Anything else is answered with E060, like the real device (and the string_echo Arduino).
+
+The motors move with the given speed on every axis (speed 0: the axis does not move) and stop at the limit switches
+at +-position_max.
+'''
+
+import time
+
+from virtual_device import VirtualDevice
+
+
+class VirtualInjectMan(VirtualDevice):
+	def __init__(self,
+				 position_max=25e3,
+				 version='1.0',
+				 require_remote_control=False,
+				 **transport
+				 ) -> None:
+		"""
+		:param position_max: position of the limit switches in micrometers (on both sides of 0)
+		:param require_remote_control: if True, GOTO and STOP are answered with E060 unless remote control is active
+		:param transport: baud_rate, latency, drop_rate, garble_rate, seed (see VirtualDevice)
+		"""
+		super().__init__(**transport)
+		self.position_max = position_max
+		self.version = version
+		self.require_remote_control = require_remote_control
+		self.remote_control = False
+		self.n_beeps = 0
+
+		# Current movement: start position, target, speeds (micrometers/s) and start time
+		self._start = [0.0, 0.0, 0.0]
+		self._target = [0.0, 0.0, 0.0]
+		self._speed = [0.0, 0.0, 0.0]
+		self._t_start = time.perf_counter()
+
+	def handle_command(self, command: bytes):
+		parts = command.decode(errors='replace').strip().split(' ')
+		code = parts[0].upper()
+		try:
+			parameters = [int(float(x)) for x in parts[1:]]
+		except ValueError:
+			return b'E060\r\n'
+
+		if code == 'C001':
+			return f'A001 {self.version}\r\n'.encode()
+		if code == 'C003':
+			self._start, self._target, self._speed = [0.0]*3, [0.0]*3, [0.0]*3
+			return b'A003\r\n'
+		if code in ('C004', 'C005'):
+			self.remote_control = code == 'C004'
+			return f'A{code[1:]}\r\n'.encode()
+		if code in ('C007', 'C012', 'C008') and self.require_remote_control and not self.remote_control:
+			return b'E060\r\n'
+		if code in ('C007', 'C012') and len(parameters) == 6:
+			t_move = self.goto(parameters[:3], parameters[3:])
+			if code == 'C012':
+				return b'A012\r\n'
+			# Blocking GOTO: the answer comes when all the motors have stopped (the device does nothing else meanwhile).
+			time.sleep(t_move)
+			return f'A007 {self.limit_switches()}\r\n'.encode()
+		if code == 'C008':
+			self.stop_motors()
+			return b'A008\r\n'
+		if code == 'C010':
+			d1, d2, d3 = self.position()
+			return f'A010 {round(d1)} {round(d2)} {round(d3)} {self.limit_switches()}\r\n'.encode()
+		if code in ('C014', 'C015') and len(parameters) == 1:
+			self.n_beeps += parameters[0]
+			return f'A{code[1:]}\r\n'.encode()
+		return b'E060\r\n'
+
+	# ------------------------------------------------------------------------------
+	# Model of the motors
+
+	def position(self) -> list:
+		"""Current motor positions in micrometers."""
+		t = time.perf_counter() - self._t_start
+		position = []
+		for start, target, speed in zip(self._start, self._target, self._speed):
+			distance = target - start
+			travelled = min(abs(distance), speed * t)
+			position.append(start + travelled if distance >= 0 else start - travelled)
+		return position
+
+	def goto(self, target, speed) -> float:
+		"""Start a movement. Returns the time in s until all the motors stop."""
+		self._start = self.position()
+		self._target = [max(-self.position_max, min(p, self.position_max)) if v != 0 else s
+						for p, v, s in zip(target, speed, self._start)]
+		self._speed = [abs(v) for v in speed]
+		self._t_start = time.perf_counter()
+		return max((abs(p - s) / v if v else 0) for p, s, v in zip(self._target, self._start, self._speed))
+
+	def stop_motors(self):
+		self._start = self.position()
+		self._target = list(self._start)
+		self._t_start = time.perf_counter()
+
+	def limit_switches(self) -> int:
+		"""Limit switch bits: left/right 1/2, back/front 4/8, up/down 16/32 (see position_query_in_micrometers)."""
+		bits = 0
+		for axis, p in enumerate(self.position()):
+			if p <= -self.position_max:
+				bits |= 1 << (2*axis)
+			elif p >= self.position_max:
+				bits |= 2 << (2*axis)
+		return bits
@@ -0,0 +1,159 @@
+'''
+Binary framing for the voltage control Arduino (optional, the ASCII protocol stays the default).
+
+Every command and every answer is one fixed size frame of 6 bytes:
+    byte 0     sync byte 0xA5
+    byte 1     command id (see the CMD_ constants), the answer repeats the command id (CMD_ERROR if it failed)
+    byte 2     tip index
+    bytes 3-4  value, int16 little endian (voltage in mV, 0 in queries)
+    byte 5     checksum: sum of bytes 1-4 modulo 256
+
+Compared to ASCII ("!SI 0 1000\r" + "!SI 0 1000\r\n") a set + sense pair is 24 instead of ~40 bytes on the wire,
+and both sides decode it with a single unpack instead of formatting and parsing text.
+The firmware has to implement the same frames; LoopbackSerial below is a stand-in of the Arduino side.
+'''
+
+import struct
+import threading
+
+
+SYNC = 0xA5
+FRAME_SIZE = 6
+
+CMD_SET_VOLTAGE = 0x01     # '!SI tip value' - answer value: the set V-in
+CMD_SENSE = 0x02           # '?SS tip'       - answer value: V-sense
+CMD_ERROR = 0xFF
+
+_frame = struct.Struct('<BBBhB')
+_payload = struct.Struct('<BBh')
+
+# Candidate frames (starting with a sync byte) dropped because of a wrong checksum, see take_frames().
+n_bad_frames = 0
+
+
+class FrameError(ValueError):
+    """Frame with a wrong sync byte, size or checksum."""
+
+
+def _checksum(frame_bytes) -> int:
+    return sum(frame_bytes[1:5]) & 0xFF
+
+
+def is_valid(frame_bytes) -> bool:
+    """The frame (FRAME_SIZE bytes) starts with the sync byte and its checksum is right."""
+    return frame_bytes[0] == SYNC and frame_bytes[5] == _checksum(frame_bytes)
+
+
+def encode_frame(command: int, tip: int, value: int = 0) -> bytes:
+    payload = _payload.pack(command, tip, value)
+    return bytes((SYNC,)) + payload + bytes((sum(payload) & 0xFF,))
+
+
+def encode_frames(frames) -> bytes:
+    """Encode (command, tip, value) tuples into one string of bytes (for a single write)."""
+    return b''.join(encode_frame(*frame) for frame in frames)
+
+
+def decode_frame(frame_bytes) -> tuple:
+    """Decode one frame to (command, tip, value). Raises FrameError if the frame is corrupted."""
+    if len(frame_bytes) != FRAME_SIZE:
+        raise FrameError(f'Frame has {len(frame_bytes)} bytes instead of {FRAME_SIZE}: {bytes(frame_bytes)}')
+    sync, command, tip, value, checksum = _frame.unpack(frame_bytes)
+    if sync != SYNC or checksum != _checksum(frame_bytes):
+        raise FrameError(f'Corrupted frame: {bytes(frame_bytes)}')
+    return command, tip, value
+
+
+def take_frames(buf: bytearray) -> list:
+    """
+    Remove all complete frames from the beginning of buf and return them (undecoded).
+
+    Bytes before a sync byte are dropped (resynchronization after garbage on the line). A candidate frame with a
+    wrong checksum is not taken: its sync byte may be a 0xA5 inside a payload (after a lost byte), so the search
+    goes on from the next byte and n_bad_frames is counted up.
+    """
+    global n_bad_frames
+    frames = []
+    start = 0
+    while True:
+        start = buf.find(SYNC, start)
+        if start < 0:
+            buf.clear()
+            return frames
+        if len(buf) - start < FRAME_SIZE:
+            del buf[:start]
+            return frames
+        frame = bytes(buf[start:start + FRAME_SIZE])
+        if is_valid(frame):
+            frames.append(frame)
+            start += FRAME_SIZE
+        else:
+            n_bad_frames += 1
+            start += 1
+
+
+class LoopbackSerial:
+    """
+    In-memory stand-in for the serial port with the Arduino answering binary frames.
+
+    Implements the part of serial.Serial used by serialConnection, so it can be passed as serial_port:
+        serialConnection(port='loopback', protocol='binary', serial_port=LoopbackSerial())
+    Set voltages are kept per tip and sensed back as V-sense = sense_gain * V-in.
+    """
+    def __init__(self, timeout: float = 0.1, sense_gain: float = 1.0) -> None:
+        self.timeout = timeout
+        self.sense_gain = sense_gain
+        self.port = 'loopback'
+        self.is_open = True
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+        self._voltages = {}
+        self._input = bytearray()
+        self._output = bytearray()
+        self._data_available = threading.Condition()
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self._output)
+
+    def write(self, data) -> int:
+        self.bytes_written += len(data)
+        self._input.extend(data)
+        answers = [self._answer(frame) for frame in take_frames(self._input)]
+        with self._data_available:
+            self._output.extend(b''.join(answers))
+            self._data_available.notify_all()
+        return len(data)
+
+    def _answer(self, frame_bytes) -> bytes:
+        try:
+            command, tip, value = decode_frame(frame_bytes)
+        except FrameError:
+            return encode_frame(CMD_ERROR, 0, 0)
+        if command == CMD_SET_VOLTAGE:
+            self._voltages[tip] = value
+            return encode_frame(command, tip, value)
+        if command == CMD_SENSE:
+            return encode_frame(command, tip, int(self.sense_gain * self._voltages.get(tip, 0)))
+        return encode_frame(CMD_ERROR, tip, command)
+
+    def read(self, size: int = 1) -> bytes:
+        with self._data_available:
+            if not self.is_open:
+                raise OSError(f'Port {self.port} is closed.')
+            if len(self._output) < size:
+                self._data_available.wait_for(lambda: len(self._output) >= size or not self.is_open, self.timeout)
+            data = bytes(self._output[:size])
+            del self._output[:size]
+        self.bytes_read += len(data)
+        return data
+
+    def reset_input_buffer(self):
+        with self._data_available:
+            self._output.clear()
+
+    def close(self):
+        with self._data_available:
+            self.is_open = False
+            self._data_available.notify_all()
@@ -0,0 +1,118 @@
+'''
+Trace of the commands sent to the devices, instead of logging.DEBUG on the hot path.
+
+Every command is recorded as an event (time sent, time answered, port, command, answer) in a ring buffer in memory
+that keeps the last `capacity` events. Nothing is formatted or printed during the run, so tracing does not slow the
+control loop down; when it is off, a command costs one check of command_trace.enabled.
+
+    import command_trace
+    command_trace.enable()
+    ... run ...
+    command_trace.dump(20)            # the last 20 events
+    command_trace.summary()           # latency per command
+    command_trace.save('trace.csv')   # all events, for looking at them elsewhere
+
+The times are in s since enable().
+'''
+
+import csv
+import time
+from collections import deque
+
+import numpy as np
+
+
+enabled = False
+_events = deque(maxlen=100000)
+_t_zero = time.perf_counter()
+
+
+def enable(capacity=100000):
+	"""Start recording. Events of an earlier trace are discarded."""
+	global enabled, _events, _t_zero
+	_events = deque(maxlen=capacity)
+	_t_zero = time.perf_counter()
+	enabled = True
+
+
+def disable():
+	"""Stop recording. The events are kept until the next enable()."""
+	global enabled
+	enabled = False
+
+
+def record(port, command, answer, t_send, t_receive=None):
+	"""
+	Record one command and its answer (None if it was not waited for). Only call it if enabled.
+
+	:param command: command as sent (bytes or str, with or without the terminator)
+	:param t_send, t_receive: time.perf_counter() before the write and after the answer arrived
+	"""
+	# deque.append is atomic, so the reader threads and the event loop can record at the same time.
+	_events.append((t_send, t_receive, port, command, answer))
+
+
+def record_batch(port, commands, answers, t_send, t_receive=None):
+	"""record() for several commands sent in one write. answers: one per command, or None."""
+	if answers is None:
+		answers = [None] * len(commands)
+	for command, answer in zip(commands, answers):
+		_events.append((t_send, t_receive, port, command, answer))
+
+
+def clear():
+	_events.clear()
+
+
+def events():
+	"""The recorded events as a list of dicts (oldest first)."""
+	result = []
+	for t_send, t_receive, port, command, answer in list(_events):
+		result.append({'t_send': t_send - _t_zero,
+					   't_receive': None if t_receive is None else t_receive - _t_zero,
+					   'latency_ms': None if t_receive is None else (t_receive - t_send) * 1e3,
+					   'port': port,
+					   'command': _text(command),
+					   'answer': _text(answer)})
+	return result
+
+
+def dump(n=20):
+	"""Print the last n events."""
+	for event in events()[-n:]:
+		latency = '' if event['latency_ms'] is None else f"{event['latency_ms']:8.3f} ms"
+		print(f"{event['t_send']:10.4f} s  {event['port']:<14} {latency:>11}  {event['command']:<30} -> {event['answer']}")
+
+
+def summary():
+	"""Print the number of calls and the latency (mean, p50, p99, max in ms) per command name."""
+	latencies = {}
+	for event in events():
+		if event['latency_ms'] is not None:
+			latencies.setdefault(event['command'].split(' ')[0], []).append(event['latency_ms'])
+	print(f"{'command':<12} {'n':>8} {'mean':>8} {'p50':>8} {'p99':>8} {'max':>8}   [ms]")
+	for name, values in sorted(latencies.items()):
+		values = np.array(values)
+		print(f'{name:<12} {len(values):>8} {values.mean():8.3f} {np.percentile(values, 50):8.3f} '
+			  f'{np.percentile(values, 99):8.3f} {values.max():8.3f}')
+
+
+def save(path):
+	"""Write all events to a CSV file."""
+	with open(path, 'w', newline='') as f:
+		writer = csv.DictWriter(f, fieldnames=['t_send', 't_receive', 'latency_ms', 'port', 'command', 'answer'])
+		writer.writeheader()
+		writer.writerows(events())
+
+
+def _text(message):
+	if message is None:
+		return ''
+	if isinstance(message, (bytes, bytearray, memoryview)):
+		return bytes(message).decode(errors='replace').strip()
+	if isinstance(message, str):
+		return message.strip()
+	if isinstance(message, tuple):
+		# Frame of the binary protocol: command tip value
+		return ' '.join(str(x) for x in message)
+	return str(message)
@@ -0,0 +1,253 @@
+'''
+Scan of a list or grid of sites: move the tip of the InjectMan to a site, drive the coils there with a waveform,
+go on to the next site.
+
+Everything that can be done before the start is: the order of the sites (a short path through all of them), the motor
+positions (checked against the range of the InjectMan) and the waveforms of all the sites. The measurements of a site
+are streamed to the RunStore during its waveform (see my_funcs.run_waveform()), so an interrupt in the middle of a
+site keeps the samples so far. The tip is not idle while the end of a waveform is recorded: the move to the next site
+(non blocking GOTO) is sent from a worker thread when the trailing 0 V tail of the waveform starts (after the last
+pulse, see waveforms.t_after_signal), and waited for before the next waveform. The settle time counts from the
+arrival. With move_in_tail=False the move is sent only after the waveform, for when the tip must not move while
+the tail is recorded.
+
+    import sys; sys.path.append('../inject_man')
+    from inject_man import InjectMan
+    im = InjectMan(port='COM1'); im.call_command_code(4)   # remote control
+    sites = grid_sites(x=np.arange(0, 1000, 250), y=np.arange(0, 500, 250))
+    spec = {'profile': 'multi_box', 't_on': 1, 't_off': 2, 'N_pulses': 5, 'voltage_ampl': 1000}
+    scan = GridScan(im, sc, sites, spec, tip_idx=0, store=RunStore('data/scan_1'), settle_time=0.5)
+    print(scan.estimated_duration())
+    measurements = scan.run()
+    scan.print_stats()
+'''
+
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import waveforms
+import my_funcs
+from run_storage import RunStore
+
+
+def grid_sites(x, y, z=0) -> np.ndarray:
+    """
+    Sites [x, y, z] of a grid, in snake order: every row of the grid is scanned in the other direction than the
+    previous one, so the tip never goes back to the start of a row.
+
+    :param x, y, z: coordinates of the grid lines (a single number for a plane)
+    :return: (N, 3) array of positions
+    """
+    x, y, z = (np.atleast_1d(np.asarray(c, dtype=float)) for c in (x, y, z))
+    sites = []
+    for i, (zi, yi) in enumerate((zi, yi) for zi in z for yi in y):
+        xs = x if i % 2 == 0 else x[::-1]
+        sites.append(np.column_stack((xs, np.full(len(xs), yi), np.full(len(xs), zi))))
+    return np.concatenate(sites)
+
+
+def plan_path(sites, start=None) -> np.ndarray:
+    """
+    Order of the sites for a short path: always on to the nearest site that was not visited yet.
+
+    :param sites: (N, 3) positions
+    :param start: position the tip starts from (default: the first site)
+    :return: indices of the sites in the order they are visited
+    """
+    sites = np.asarray(sites, dtype=float)
+    left = np.ones(len(sites), dtype=bool)
+    position = sites[0] if start is None else np.asarray(start, dtype=float)
+    order = []
+    for _ in range(len(sites)):
+        distances = np.where(left, np.linalg.norm(sites - position, axis=1), np.inf)
+        i = int(np.argmin(distances))
+        order.append(i)
+        left[i] = False
+        position = sites[i]
+    return np.array(order, dtype=int)
+
+
+class GridScan:
+    def __init__(self, injectman, serial: object, sites, profiles, tip_idx: int, store: RunStore = None,
+                 v: float = None, settle_time: float = 0.5, dT: float = 0.05, reorder: bool = False,
+                 tolerance: float = 2, metadata: dict = None, move_in_tail: bool = True) -> None:
+        """
+        :param injectman: the InjectMan (remote control active)
+        :param serial: serialConnection of the Arduino of the coils
+        :param sites: (N, 3) positions [x, y, z] (see grid_sites())
+        :param profiles: waveform of the sites: a profile spec (see waveforms.compile_profile()) or a Waveform for
+                         all of them, or a list with one per site
+        :param tip_idx: tip driven with the waveform
+        :param store: RunStore for the measurements (one run per site); None: only returned by run()
+        :param v: speed of the moves in micrometers/s (default: the default speed of the InjectMan)
+        :param settle_time: time in s to wait at a site after the arrival before the waveform starts
+        :param dT: time step of the voltage control loop in s
+        :param reorder: visit the sites in the order of plan_path() instead of the given order
+        :param tolerance: distance in micrometers (on every motor) at which a site counts as reached
+        :param metadata: added to the metadata of every run (for example the name of the sample)
+        :param move_in_tail: send the move to the next site when the 0 V tail of the waveform starts, instead of
+                             after the waveform
+        """
+        self.injectman = injectman
+        self.sc = serial
+        self.tip_idx = tip_idx
+        self.store = store
+        self.v = v if v is not None else injectman.default_speed
+        self.settle_time = settle_time
+        self.dT = dT
+        self.tolerance = tolerance
+        self.metadata = dict(metadata) if metadata is not None else {}
+        self.move_in_tail = move_in_tail
+
+        sites = np.asarray(sites, dtype=float).reshape(-1, 3)
+        if not isinstance(profiles, list):
+            profiles = [profiles]*len(sites)
+        if len(profiles) != len(sites):
+            raise ValueError(f'Got {len(sites)} sites and {len(profiles)} profiles.')
+
+        self.order = plan_path(sites) if reorder else np.arange(len(sites))
+        self.sites = sites[self.order]
+        # Checked before the start, so the scan does not stop half way at a site out of range.
+        self.d_sites = injectman._p2d(self.sites)
+        outside = np.any(np.abs(self.d_sites) > injectman.position_max_micrometers, axis=1)
+        if np.any(outside):
+            raise ValueError(f'Sites {self.order[outside].tolist()} are outside of the range of the InjectMan.')
+
+        # Compiled once, the waveform of a site is ready when the tip arrives.
+        self.waveforms = []
+        self.profiles = []
+        for i in self.order:
+            profile = profiles[i]
+            if isinstance(profile, waveforms.Waveform):
+                self.waveforms.append(profile)
+                self.profiles.append({'profile': 'waveform', 'n_breakpoints': len(profile)})
+            else:
+                self.waveforms.append(waveforms.compile_profile(profile))
+                self.profiles.append(dict(profile))
+
+        self.timing = []  # per site: t_move, t_settle, t_run in s (see print_stats())
+        self.t_total = None
+
+    def estimated_duration(self) -> float:
+        """Time in s of the scan from the speeds, settle times and waveforms (without the serial latency)."""
+        start = self.injectman._start_position() if not self.injectman.is_simulated else self.d_sites[0]
+        distances = np.diff(np.trunc(self.d_sites), axis=0, prepend=[start])
+        speeds = self.injectman._synchronized_speeds(distances, self.v)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_moves = np.nanmax(np.where(speeds > 0, np.abs(distances) / speeds, 0), axis=1)
+        # The moves after the first one overlap with the tail of the previous waveform.
+        tails = np.array([self._tail(w) for w in self.waveforms[:-1]] or np.zeros(0))
+        t_moves[1:] = np.maximum(0.0, t_moves[1:] - tails)
+        return float(t_moves.sum() + len(self.sites)*self.settle_time + sum(w.t_end for w in self.waveforms))
+
+    def run(self) -> list:
+        """
+        Run the scan. Returns the measurements of the sites (MeasurementBuffer, in the order they were visited).
+
+        On an interrupt the tip is stopped; the sites done so far and the samples of the current site are saved.
+        """
+        results = []
+        self.timing = []
+        t_start = time.perf_counter()
+        mover = ThreadPoolExecutor(max_workers=1, thread_name_prefix='scan_move')
+        abort = threading.Event()
+        next_move = None
+        try:
+            t_arrival = self._move(0)
+            for k in range(len(self.sites)):
+                t_move_start = time.perf_counter()
+                self._wait_for_arrival(k, t_arrival)
+                t_arrived = time.perf_counter()
+                time.sleep(max(0.0, t_arrived + self.settle_time - time.perf_counter()))
+                t_run_start = time.perf_counter()
+
+                if k + 1 < len(self.sites) and self.move_in_tail:
+                    # One tick after the tail starts, so the move never comes before the end of the last pulse.
+                    t_send = t_run_start + self.waveforms[k].t_end - self._tail(self.waveforms[k]) + self.dT
+                    next_move = mover.submit(self._move_at, k + 1, t_send, abort)
+                measurements = my_funcs.run_waveform(self.waveforms[k], self.tip_idx, self.sc, self.dT,
+                                                     store=self.store, metadata=self._site_metadata(k))
+                t_run_end = time.perf_counter()
+
+                if next_move is not None:
+                    t_arrival = next_move.result()
+                    next_move = None
+                elif k + 1 < len(self.sites):
+                    t_arrival = self._move(k + 1)
+                results.append(measurements)
+                self.timing.append((t_arrived - t_move_start, t_run_start - t_arrived, t_run_end - t_run_start))
+        except BaseException as error:
+            # No move after the STOP: the pending one is cancelled or waited for.
+            abort.set()
+            mover.shutdown(wait=True)
+            try:
+                self.injectman.STOP()
+            except Exception as e:
+                logging.error(f'STOP of the InjectMan after "{error!r}" failed: {e!r}')
+            raise
+        finally:
+            mover.shutdown(wait=True)
+            self.t_total = time.perf_counter() - t_start
+        return results
+
+    def print_stats(self):
+        if not self.timing:
+            return
+        t_move, t_settle, t_run = np.array(self.timing).sum(axis=0)
+        print(f'{len(self.timing)} sites in {self.t_total:.2f} s: waveforms {t_run:.2f} s, settling {t_settle:.2f} s, '
+              f'waiting for the tip {t_move:.2f} s')
+
+    def _site_metadata(self, k) -> dict:
+        metadata = dict(self.metadata, **self.profiles[k])
+        metadata.update(scan_site=int(self.order[k]), scan_index=k, position=self.sites[k].tolist())
+        return metadata
+
+    @staticmethod
+    def _tail(waveform) -> float:
+        """Length in s of the 0 V tail at the end of the waveform (0 if it ends at another voltage)."""
+        if len(waveform) == 0:
+            return waveform.t_end
+        if waveform.values[-1] != 0:
+            return 0.0
+        return max(0.0, waveform.t_end - float(waveform.breakpoints[-1]))
+
+    def _move_at(self, k, t_send, abort) -> float:
+        """Worker thread: _move(k) at t_send (time.perf_counter()), unless abort is set first."""
+        if abort.wait(max(0.0, t_send - time.perf_counter())):
+            return None
+        return self._move(k)
+
+    def _move(self, k) -> float:
+        """Send the non blocking GOTO to site k. Returns the time (time.perf_counter()) it is expected to arrive."""
+        self.injectman.move_to(self.sites[k], self.v, wait_for_completion=False)
+        move = self.injectman.last_move
+        if move is None or move.start is None:
+            return time.perf_counter()
+        moving = move.speeds > 0
+        if not np.any(moving):
+            return move.t
+        return move.t + np.max(np.abs(move.target - move.start)[moving] / move.speeds[moving])
+
+    def _wait_for_arrival(self, k, t_arrival):
+        """Wait until the motors are at site k (queried, the expected arrival is only used to query less)."""
+        if self.injectman.is_simulated:
+            return
+        time.sleep(max(0.0, t_arrival - time.perf_counter()))
+        target = np.trunc(self.d_sites[k])
+        reply = np.zeros(4, dtype=np.int64)
+        previous = None
+        t_last_move = time.perf_counter()
+        while True:
+            self.injectman.position_query_array(reply)
+            if np.all(np.abs(target - reply[:3]) <= self.tolerance):
+                return
+            if previous is not None and np.any(reply[:3] != previous):
+                t_last_move = time.perf_counter()
+            elif time.perf_counter() - t_last_move > 1.0:
+                raise RuntimeError(f'InjectMan stopped at {reply[:3]} before site {self.order[k]} ({target}). Limit switches: {reply[3]}')
+            previous = reply[:3].copy()
+            time.sleep(0.01)
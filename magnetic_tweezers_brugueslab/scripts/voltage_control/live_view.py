@@ -0,0 +1,268 @@
+'''
+Live plot of V-set, V-in and V-sense of the current run, without slowing down the control loop.
+
+The plot runs in its own process. While it is open, the measurement buffers of the runs (see measurement_buffer.py)
+are allocated in shared memory, and the name of the segment of the current run is published in a small registry
+segment. The control loop only writes its samples as before, it never waits for the plot; the plot process reads
+the samples written so far, at most max_fps times per s. Only the lines are redrawn (blitting, the axes are drawn
+again only when the run or the voltage range changes), and long runs are decimated to max_points per line (minimum
+and maximum of every bucket, so the edges stay visible).
+
+    view = LiveView(max_fps=10).start()
+    measurements = my_funcs.multi_box(5, 15, 10, 1000, 0, sc)   # shows up in the live view
+    view.stop()
+
+The window needs an interactive matplotlib backend in the plot process (the default one of the system, even when
+the notebook uses %matplotlib inline).
+'''
+
+import time
+import struct
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import measurement_buffer
+from measurement_buffer import measurement_dtype
+
+
+registry_name = 'magnetic_tweezers_live'
+_registry = struct.Struct('<q56s')  # generation (incremented for every new segment), name of the segment
+_generation = struct.Struct('<q')
+_name = struct.Struct('56s')
+_header = struct.Struct('<qqd40x')  # capacity, number of samples, t_end (64 bytes, then the columns)
+_header_size = 64
+_n_offset = 8
+
+
+def _column_offsets(capacity: int) -> dict:
+    offsets = {}
+    offset = _header_size
+    for name in measurement_dtype.names:
+        offsets[name] = offset
+        # 8 byte aligned
+        offset += -(-capacity * measurement_dtype[name].itemsize // 8) * 8
+    offsets['_size'] = offset
+    return offsets
+
+
+def _columns_in(buf, capacity: int) -> dict:
+    offsets = _column_offsets(capacity)
+    return {name: np.ndarray(capacity, dtype=measurement_dtype[name], buffer=buf, offset=offsets[name])
+            for name in measurement_dtype.names}
+
+
+class _SharedColumns:
+    """Shared memory segment with the columns of one MeasurementBuffer (see measurement_buffer.column_allocator)."""
+    def __init__(self, capacity: int, t_end: float) -> None:
+        self.segment = shared_memory.SharedMemory(create=True, size=_column_offsets(capacity)['_size'])
+        _header.pack_into(self.segment.buf, 0, capacity, 0, t_end)
+        self.columns = _columns_in(self.segment.buf, capacity)
+        self.n = np.ndarray(1, dtype=np.int64, buffer=self.segment.buf, offset=_n_offset)
+
+    def release(self):
+        # Arrays handed out by the buffer may still use the memory: then it stays mapped in this process until they
+        # are gone, but the segment is removed.
+        self.columns = self.n = None
+        try:
+            self.segment.unlink()
+        except FileNotFoundError:
+            pass
+        try:
+            self.segment.close()
+        except BufferError:
+            pass
+
+
+class _Publisher:
+    """measurement_buffer.column_allocator of the acquisition process: allocates shared columns and publishes them."""
+    def __init__(self, registry: shared_memory.SharedMemory) -> None:
+        self.registry = registry
+        self.generation = 0
+
+    def __call__(self, capacity: int, metadata: dict) -> tuple:
+        shared = _SharedColumns(capacity, float(metadata.get('t_end', 0) or 0))
+        self.generation += 1
+        # Generation -1 while the name is written, the new generation last: SharedRunReader.poll() only takes a name
+        # read between two equal, valid generations.
+        _generation.pack_into(self.registry.buf, 0, -1)
+        _name.pack_into(self.registry.buf, _generation.size, shared.segment.name.encode())
+        _generation.pack_into(self.registry.buf, 0, self.generation)
+        return shared.columns, shared.n, shared
+
+
+class SharedRunReader:
+    def __init__(self, registry: str = registry_name) -> None:
+        """Reads the current run from the shared memory of the acquisition process (in the live view process)."""
+        self.registry = shared_memory.SharedMemory(name=registry)
+        self.generation = 0
+        self.segment = None
+        self.columns = None
+        self.n = None
+        self.t_end = 0.0
+
+    def poll(self) -> bool:
+        """Follow the registry to the segment of the current run. Returns True if it changed."""
+        generation, name = _registry.unpack_from(self.registry.buf, 0)
+        if generation == self.generation or generation < 0:
+            return False
+        if _generation.unpack_from(self.registry.buf, 0)[0] != generation:
+            # Published again while the name was read, the next poll gets the new one.
+            return False
+        name = name.rstrip(b'\0').decode()
+        try:
+            # The plot process shares the resource tracker of the acquisition process (spawned by it), so attaching
+            # does not register the segment a second time; the acquisition process removes it.
+            segment = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            # Already replaced (the buffer grew), the next poll gets the new one.
+            return False
+        self._close_segment()
+        self.segment = segment
+        capacity, _, self.t_end = _header.unpack_from(segment.buf, 0)
+        self.columns = _columns_in(segment.buf, capacity)
+        self.n = np.ndarray(1, dtype=np.int64, buffer=segment.buf, offset=_n_offset)
+        self.generation = generation
+        return True
+
+    def samples(self, names=('t_set', 'V_set', 'V_in', 'V_sense')) -> tuple:
+        """Copies of the columns of the samples written so far."""
+        if self.columns is None:
+            return tuple(np.empty(0, dtype=measurement_dtype[name]) for name in names)
+        n = int(self.n[0])
+        return tuple(self.columns[name][:n].copy() for name in names)
+
+    def _close_segment(self):
+        if self.segment is not None:
+            self.columns = self.n = None
+            self.segment.close()
+            self.segment = None
+
+    def close(self):
+        self._close_segment()
+        self.registry.close()
+
+
+def decimate(t, y, max_points: int) -> tuple:
+    """
+    At most about max_points points of (t, y) for plotting: the minimum and the maximum of every bucket of samples,
+    in the order they occur, so short pulses and edges stay visible.
+    """
+    n = len(t)
+    if n <= max_points:
+        return t, y
+    n_buckets = max(1, max_points // 2)
+    size = n // n_buckets
+    n_used = n_buckets * size
+    buckets = y[:n_used].reshape(n_buckets, size)
+    i_min = buckets.argmin(axis=1) + size * np.arange(n_buckets)
+    i_max = buckets.argmax(axis=1) + size * np.arange(n_buckets)
+    i = np.sort(np.concatenate((i_min, i_max, np.arange(n_used, n))))
+    return t[i], y[i]
+
+
+def _run_viewer(registry: str, max_fps: float, max_points: int, stop):
+    import matplotlib.pyplot as plt
+
+    reader = SharedRunReader(registry)
+    fig, ax = plt.subplots()
+    fig.patch.set_facecolor('white')
+    lines = [ax.plot([], [], style, label=label, animated=True)[0]
+             for style, label in [('b-', 'V-set'), (':.', 'V-in'), (':.', 'V-sense')]]
+    ax.legend(loc='upper right')
+    ax.set_xlabel('t [s]')
+    ax.set_ylabel('V [mV]')
+    ax.set_ylim(-100, 1000)
+    plt.show(block=False)
+
+    background = None
+    frame_interval = 1 / max_fps
+    while not stop.is_set() and plt.fignum_exists(fig.number):
+        t_frame = time.perf_counter()
+        redraw = background is None
+        if reader.poll():
+            ax.set_xlim(0, max(reader.t_end, 1e-3))
+            redraw = True
+        t, *columns = reader.samples()
+        if len(t):
+            v_min = min(int(c.min()) for c in columns)
+            v_max = max(int(c.max()) for c in columns)
+            low, high = ax.get_ylim()
+            if v_min < low or v_max > high:
+                margin = 0.1 * max(v_max - v_min, 100)
+                ax.set_ylim(min(low, v_min - margin), max(high, v_max + margin))
+                redraw = True
+            if t[-1] > ax.get_xlim()[1]:
+                ax.set_xlim(0, 1.5 * t[-1])
+                redraw = True
+        for line, y in zip(lines, columns):
+            line.set_data(*decimate(t, y, max_points))
+
+        if redraw:
+            # The axes only: the lines are animated and drawn on top of the saved background.
+            fig.canvas.draw()
+            background = fig.canvas.copy_from_bbox(fig.bbox)
+        fig.canvas.restore_region(background)
+        for line in lines:
+            ax.draw_artist(line)
+        fig.canvas.blit(fig.bbox)
+        fig.canvas.flush_events()
+        time.sleep(max(0.0, frame_interval - (time.perf_counter() - t_frame)))
+
+    reader.close()
+    plt.close(fig)
+
+
+class LiveView:
+    def __init__(self, max_fps: float = 10, max_points: int = 2000) -> None:
+        """
+        :param max_fps: maximal redraws per s
+        :param max_points: maximal points per line (longer runs are decimated, see decimate())
+        """
+        self.max_fps = max_fps
+        self.max_points = max_points
+        self._registry = None
+        self._process = None
+        self._stop = None
+
+    def start(self):
+        """Open the plot window. The runs started from now on are shown."""
+        try:
+            self._registry = shared_memory.SharedMemory(name=registry_name, create=True, size=_registry.size)
+        except FileExistsError:
+            # Left over from a crashed session.
+            self._registry = shared_memory.SharedMemory(name=registry_name)
+        _registry.pack_into(self._registry.buf, 0, 0, b'')
+        measurement_buffer.column_allocator = _Publisher(self._registry)
+
+        # spawn: a fresh interpreter, whatever the notebook (matplotlib backend, threads) has set up.
+        context = multiprocessing.get_context('spawn')
+        self._stop = context.Event()
+        self._process = context.Process(target=_run_viewer, args=(registry_name, self.max_fps, self.max_points, self._stop),
+                                        name='live_view', daemon=True)
+        self._process.start()
+        return self
+
+    def stop(self):
+        """Close the window. The runs from now on use normal memory again."""
+        measurement_buffer.column_allocator = None
+        if self._process is not None:
+            self._stop.set()
+            self._process.join(timeout=2)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
+        if self._registry is not None:
+            self._registry.close()
+            try:
+                self._registry.unlink()
+            except FileNotFoundError:
+                pass
+            self._registry = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
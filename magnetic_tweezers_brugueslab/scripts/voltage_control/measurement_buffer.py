@@ -0,0 +1,132 @@
+'''
+Preallocated columnar buffer for the measurements of the control loops in my_funcs.py.
+
+Every column is a NumPy array that is allocated before the run (and doubled if the run takes more samples than
+expected), so a tick only writes numbers into the arrays and creates no Python lists.
+
+While a live view is open (see live_view.py), the columns of new buffers are allocated in shared memory, where the
+live view process reads them during the run.
+'''
+
+import weakref
+import numpy as np
+
+
+# Columns of the buffer:
+#   t_set   - time in s at which the setpoint was set
+#   t_meas  - time in s at which V-sense was read back
+#   V_set   - setpoint (from the waveform) in mV
+#   V_in    - control voltage confirmed by the Arduino in mV
+#   V_sense - measured voltage in mV
+#   tip     - tip_idx
+measurement_dtype = np.dtype([
+    ('t_set', np.float64),
+    ('t_meas', np.float64),
+    ('V_set', np.int32),
+    ('V_in', np.int32),
+    ('V_sense', np.int32),
+    ('tip', np.int16),
+])
+
+
+# Allocator of the columns of new buffers, None for normal memory. live_view.LiveView sets it while it is open.
+# Called as column_allocator(capacity, metadata), returns (columns dict, published number of samples as an int64
+# array of size 1, handle with release()).
+column_allocator = None
+
+
+def _allocate(capacity: int, metadata: dict) -> tuple:
+    if column_allocator is not None:
+        return column_allocator(capacity, metadata)
+    columns = {name: np.zeros(capacity, dtype=measurement_dtype[name]) for name in measurement_dtype.names}
+    return columns, np.zeros(1, dtype=np.int64), None
+
+
+class MeasurementBuffer:
+    def __init__(self, capacity: int = 1024, metadata: dict = None) -> None:
+        """
+        :param capacity: number of samples to preallocate (for a run: about t_end/dT)
+        :param metadata: parameters of the run (profile, port, tip_idx, ...), kept with the data
+        """
+        self.metadata = dict(metadata) if metadata is not None else {}
+        self.n = 0
+        self._columns, self._n_published, self._shared = _allocate(max(1, capacity), self.metadata)
+        self._bind_columns()
+        self._release = weakref.finalize(self, self._shared.release) if self._shared is not None else None
+
+    def _bind_columns(self):
+        # Direct references for append(), so the hot path does no dictionary lookups.
+        c = self._columns
+        self._t_set, self._t_meas, self._V_set = c['t_set'], c['t_meas'], c['V_set']
+        self._V_in, self._V_sense, self._tip = c['V_in'], c['V_sense'], c['tip']
+
+    @property
+    def capacity(self) -> int:
+        return len(self._t_set)
+
+    def append(self, t_set: float, t_meas: float, V_set: int, V_in: int, V_sense: int, tip: int):
+        """Write one sample. The buffer doubles its capacity when it is full."""
+        i = self.n
+        if i == self.capacity:
+            self._grow()
+        self._t_set[i] = t_set
+        self._t_meas[i] = t_meas
+        self._V_set[i] = V_set
+        self._V_in[i] = V_in
+        self._V_sense[i] = V_sense
+        self._tip[i] = tip
+        self.n = i + 1
+        # For a live view: written after the sample, so a reader never sees a half written one.
+        self._n_published[0] = i + 1
+
+    def extend(self, t_set, t_meas, V_set, V_in, V_sense, tip):
+        """Write several samples at once (arrays of the same length; numbers are repeated)."""
+        n = len(V_sense)
+        while self.n + n > self.capacity:
+            self._grow()
+        i = slice(self.n, self.n + n)
+        self._t_set[i] = t_set
+        self._t_meas[i] = t_meas
+        self._V_set[i] = V_set
+        self._V_in[i] = V_in
+        self._V_sense[i] = V_sense
+        self._tip[i] = tip
+        self.n += n
+        self._n_published[0] = self.n
+
+    def _grow(self):
+        columns, n_published, shared = _allocate(2*self.capacity, self.metadata)
+        for name, column in self._columns.items():
+            columns[name][:len(column)] = column
+        n_published[0] = self.n
+        if self._release is not None:
+            self._release()
+        self._columns, self._n_published, self._shared = columns, n_published, shared
+        self._release = weakref.finalize(self, shared.release) if shared is not None else None
+        self._bind_columns()
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """Column of the recorded samples (a view, no copy), for example buffer['V_sense']."""
+        return self._columns[name][:self.n]
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return f'MeasurementBuffer({self.n} samples, capacity {self.capacity})'
+
+    @property
+    def columns(self) -> tuple:
+        return measurement_dtype.names
+
+    def as_structured(self) -> np.ndarray:
+        """Copy of the recorded samples as a structured array (with measurement_dtype)."""
+        data = np.empty(self.n, dtype=measurement_dtype)
+        for name in measurement_dtype.names:
+            data[name] = self[name]
+        return data
+
+    def clear(self):
+        """Forget the samples but keep the allocated memory."""
+        self.n = 0
+        self._n_published[0] = 0
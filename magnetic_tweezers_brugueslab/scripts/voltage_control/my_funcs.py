@@ -7,159 +7,414 @@ This scipt provides different useful functions for 'Run_VoltageControl.ipynb', m
 import time
 import numpy as np
 
+import waveforms
+import binary_protocol
+import playback_protocol
+from scheduler import DeadlineScheduler, TimeTableScheduler
+from measurement_buffer import MeasurementBuffer
+from run_storage import RunStore
+
+
+t_signal_start = waveforms.t_signal_start #s
+
+
+def set_and_sense(sc: object, tip_idx: int, voltage: int) -> tuple:
+    """
+    Set the control voltage (V-in) and read the voltage measurement (V-sense) of a tip.
+
+    Both commands are sent in one write, so the pair costs one round trip.
+    Returns the V-in confirmed by the Arduino and V-sense, both in mV.
+    """
+    if sc.protocol == 'binary':
+        (_, _, VI), (_, _, VS) = sc.send_frames([(binary_protocol.CMD_SET_VOLTAGE, tip_idx, voltage),
+                                                 (binary_protocol.CMD_SENSE, tip_idx, 0)])
+        return VI, VS
+
+    a_set, a_sense = sc.send_strings([f"!SI {tip_idx} {voltage}", f'?SS {tip_idx}'])
+    VI = int(a_set.split(' ')[2])
+    VS = int(a_sense.split(' ')[1])
+    return VI, VS
+
+
+def set_and_sense_tips(sc: object, tip_idxs: list, voltages: list) -> list:
+    """
+    set_and_sense() for several tips: the set and sense commands of all the tips are sent in one write.
+
+    Returns a list of (V-in, V-sense) in the order of tip_idxs.
+    """
+    if sc.protocol == 'binary':
+        frames = []
+        for tip_idx, voltage in zip(tip_idxs, voltages):
+            frames += [(binary_protocol.CMD_SET_VOLTAGE, tip_idx, voltage), (binary_protocol.CMD_SENSE, tip_idx, 0)]
+        answers = [value for _, _, value in sc.send_frames(frames)]
+        return list(zip(answers[0::2], answers[1::2]))
+
+    commands = []
+    for tip_idx, voltage in zip(tip_idxs, voltages):
+        commands += [f"!SI {tip_idx} {voltage}", f'?SS {tip_idx}']
+    answers = sc.send_strings(commands)
+    return [(int(a_set.split(' ')[2]), int(a_sense.split(' ')[1])) for a_set, a_sense in zip(answers[0::2], answers[1::2])]
+
+
+async def set_and_sense_async(sc: object, tip_idx: int, voltage: int) -> tuple:
+    """set_and_sense() with an asyncSerialConnection."""
+    a_set, a_sense = await sc.send_strings([f"!SI {tip_idx} {voltage}", f'?SS {tip_idx}'])
+    return int(a_set.split(' ')[2]), int(a_sense.split(' ')[1])
+
+
+def run_waveform(waveform: waveforms.Waveform, tip_idx: int, serial: object, dT: float = 0.05, missed_tick_policy: str = 'skip',
+                 store: RunStore = None, metadata: dict = None)-> MeasurementBuffer:
+    """
+    Drive a tip with a precompiled waveform (see waveforms.py) until waveform.t_end.
+
+    The setpoint of every tick is a lookup in the waveform, so the loop cost does not grow with the number of pulses.
+    Ticks are paced by a DeadlineScheduler (see scheduler.py for missed_tick_policy), its statistics are printed at the end.
+    If a RunStore is given, the measurements are streamed to it during the run (with metadata, for example the
+    profile parameters).
+    Returns the measurements in a MeasurementBuffer (columns t_set, t_meas, V_set, V_in, V_sense, tip),
+    the scheduler statistics are in its metadata['timing'].
+    """
+    sc = serial
+    measurements, writer, timer = _start_run(waveform.t_end, tip_idx, sc, dT, missed_tick_policy, store, metadata)
+
+    finished = False
+    try:
+        while timer.elapsed() < waveform.t_end:
+            t_set = timer.elapsed()
+            voltage = waveform.value_at(t_set)
+
+            # Send control voltage to Arduino - Vin and read the voltage measurement - Vsense
+            VI, VS = set_and_sense(sc, tip_idx, voltage)
+            t_meas = timer.elapsed()
+
+            measurements.append(t_set, t_meas, voltage, VI, VS, tip_idx)
+            if writer is not None:
+                writer.maybe_flush(measurements)
+            timer.wait_next()
+        finished = True
+    finally:
+        _end_run(measurements, writer, timer, finished)
 
-t_signal_start = 2 #s
+    print('Done')
+    timer.print_stats()
+    return measurements
 
-def box(t_on: int, voltage_ampl: int) -> list:
-    pass
 
+async def run_waveform_async(waveform: waveforms.Waveform, tip_idx: int, serial: object, dT: float = 0.05, missed_tick_policy: str = 'skip',
+                             store: RunStore = None, metadata: dict = None)-> MeasurementBuffer:
+    """
+    run_waveform() for asyncio, with an asyncSerialConnection (see async_serial_connection.py).
 
-def multi_box(t_on: int, t_off: int, N_pulses: int, voltage_ampl: int, tip_idx: int, serial: object)-> list:
+    Other tasks (another tip, the InjectMan, the notebook) run while waiting for answers and ticks, for example:
+        await asyncio.gather(multi_box_async(..., serial=sc), im.move_to_async(p))
+    """
     sc = serial
+    measurements, writer, timer = _start_run(waveform.t_end, tip_idx, sc, dT, missed_tick_policy, store, metadata)
+
+    finished = False
+    try:
+        while timer.elapsed() < waveform.t_end:
+            t_set = timer.elapsed()
+            voltage = waveform.value_at(t_set)
 
-    dT = 0.05 # Approximate time resolution (loop time)
-    measurements = []
-    recorded_time = []
-    set_voltage = []
-
-    period = t_on + t_off
-    t_start = time.time()
-    timer_loop_time = time.time()
-
-
-    t_recording_stop = t_signal_start + N_pulses*period + 3
-    while time.time() < t_start + t_recording_stop:
-        t = time.time() - t_start
-        recorded_time.append(t)
-        if 0 <= t%period - t_signal_start <= t_on and t < t_signal_start + N_pulses*period:
-            voltage = voltage_ampl
-        else:
-            voltage = 0
-
-        set_voltage.append(voltage)
-
-        # Send control voltage to Arduino - Vin
-        a = sc.send_string(f"!SI {tip_idx} " + str(voltage), wait_for_answer=True)
-        VI = int(a.split(' ')[2])
-        
-        # Read the voltage measurement - Vsense
-        a = sc.send_string(f'?SS {tip_idx}', wait_for_answer=True)
-        VS = int(a.split(' ')[1])
-        t = time.time() - t_start
-
-        measurements.append([t, VI, VS])
-        while time.time() < timer_loop_time + dT:
-            time.sleep(0.0001)
-        timer_loop_time = time.time()
+            VI, VS = await set_and_sense_async(sc, tip_idx, voltage)
+            t_meas = timer.elapsed()
+
+            measurements.append(t_set, t_meas, voltage, VI, VS, tip_idx)
+            if writer is not None:
+                writer.maybe_flush(measurements)
+            await timer.wait_next_async()
+        finished = True
+    finally:
+        _end_run(measurements, writer, timer, finished)
 
     print('Done')
-    return recorded_time, set_voltage, measurements
+    timer.print_stats()
+    return measurements
+
 
+def run_waveforms(waveforms_per_tip: dict, serial: object, dT: float = 0.05, missed_tick_policy: str = 'skip',
+                  store: RunStore = None, metadata: dict = None)-> MeasurementBuffer:
+    """
+    Drive several tips at once, each with its own waveform: {tip_idx: waveform, ...}.
 
-def multi_box_ampl_variation(t_on: int, t_off: int, N_pulses: int, voltage_ampl: list[int], tip_idx: int, serial: object)-> list:
+    All the tips share one timebase. In every tick the set and sense commands of all the tips go out in one write,
+    so N tips cost about one round trip instead of N. The run lasts until the longest waveform ends.
+    Returns one MeasurementBuffer with a row per tip and tick (see the tip column).
+    """
     sc = serial
+    tip_idxs = list(waveforms_per_tip)
+    waveforms_list = [waveforms_per_tip[tip_idx] for tip_idx in tip_idxs]
+    t_end = max(waveform.t_end for waveform in waveforms_list)
+    measurements, writer, timer = _start_run(t_end, tip_idxs, sc, dT, missed_tick_policy, store, metadata)
+
+    finished = False
+    try:
+        while timer.elapsed() < t_end:
+            t_set = timer.elapsed()
+            voltages = [waveform.value_at(t_set) for waveform in waveforms_list]
+
+            answers = set_and_sense_tips(sc, tip_idxs, voltages)
+            t_meas = timer.elapsed()
+
+            for tip_idx, voltage, (VI, VS) in zip(tip_idxs, voltages, answers):
+                measurements.append(t_set, t_meas, voltage, VI, VS, tip_idx)
+            if writer is not None:
+                writer.maybe_flush(measurements)
+            timer.wait_next()
+        finished = True
+    finally:
+        _end_run(measurements, writer, timer, finished)
 
-    dT = 0.05 # Approximate time resolution (loop time)
-    measurements = []
-    recorded_time = []
-    set_voltage = []
-
-    period = t_on + t_off
-    t_start = time.time()
-    timer_loop_time = time.time()
-
-    # if only V_min and V_max are given, linearly interpolate
-    if len(voltage_ampl) == 2:
-        voltage_ampl_sequence = [voltage_ampl[0] + i*(voltage_ampl[1]-voltage_ampl[0])//(N_pulses-1) for i in range(N_pulses)]
-        voltage_ampl = voltage_ampl_sequence
-        print(voltage_ampl_sequence)
-    
-    # if voltage is given as a lits, but too short, repeat pulses with the last voltage amplitude
-    elif len(voltage_ampl) < N_pulses:
-        for i in range(N_pulses- len(voltage_ampl)):
-            voltage_ampl.append(voltage_ampl[-1])
-
-    t_recording_stop = t_signal_start + N_pulses*period + 3
-    while time.time() < t_start + t_recording_stop:
-        t = time.time() - t_start
-        recorded_time.append(t)
-        if 0 <= t%period - t_signal_start <= t_on and t < t_signal_start + N_pulses*period:
-            cycle = int((t-t_signal_start)//period)
-            voltage = voltage_ampl[cycle]
-        else:
-            voltage = 0
-
-        set_voltage.append(voltage)
-
-        # Send control voltage to Arduino - Vin
-        a = sc.send_string(f"!SI {tip_idx} " + str(voltage), wait_for_answer=True)
-        VI = int(a.split(' ')[2])
-        
-        # Read the voltage measurement - Vsense
-        a = sc.send_string(f'?SS {tip_idx}', wait_for_answer=True)
-        VS = int(a.split(' ')[1])
-        t = time.time() - t_start
-
-        measurements.append([t, VI, VS])
-        while time.time() < timer_loop_time + dT:
-            time.sleep(0.0001)
-        timer_loop_time = time.time()
+    print('Done')
+    timer.print_stats()
+    return measurements
+
+
+def run_waveform_adaptive(waveform: waveforms.Waveform, tip_idx: int, serial: object, dT_edge: float = 0.005,
+                          dT_plateau: float = 0.05, window: tuple = (0.01, 0.1), stable_tolerance: int = 5,
+                          max_gap: float = 0.5, keepalive: float = 0.1, missed_tick_policy: str = 'skip',
+                          store: RunStore = None, metadata: dict = None)-> MeasurementBuffer:
+    """
+    run_waveform() with adaptive sampling: every dT_edge in a window around every edge of the waveform (to resolve
+    the rise and fall of the coil), every dT_plateau in between (see waveforms.adaptive_sample_times()).
+
+    On the plateaus it is decimated further while V-sense is stable: a sample within stable_tolerance mV of the
+    last kept one (at the same setpoint) is not kept, up to max_gap s (so there is at least one sample every max_gap
+    s), and the plateau ticks are thinned out to one every keepalive s. The setpoint is still sent at every tick
+    taken, so keepalive has to stay below the auto timeout of the Arduino (!TT, 200 ms in the notebook), otherwise
+    V-in is set to 0 in the middle of a plateau. The edge windows are always sampled.
+    :param window: (before, after) time in s around every edge that is sampled every dT_edge
+    :param keepalive: longest time in s between two setpoints on a plateau
+    """
+    sc = serial
+    times, dense = waveforms.adaptive_sample_times(waveform, dT_edge, dT_plateau, window)
+    # Time of the next tick that must be taken (in a window, or the last one), for every tick.
+    required = np.where(dense, times, np.inf)
+    required[-1] = times[-1]
+    next_required = np.minimum.accumulate(required[::-1])[::-1]
+
+    metadata = dict(metadata) if metadata is not None else {}
+    metadata.update(sampling='adaptive', dT_edge=dT_edge, dT_plateau=dT_plateau, window=list(window),
+                    stable_tolerance=stable_tolerance, max_gap=max_gap, keepalive=keepalive)
+    measurements, writer, timer = _start_run(waveform.t_end, tip_idx, sc, dT_edge, missed_tick_policy, store, metadata, times)
+
+    finished = False
+    t_kept, V_set_kept, VS_kept = -np.inf, None, None
+    try:
+        while timer.tick < len(times):
+            tick = timer.tick
+            t_set = timer.elapsed()
+            voltage = waveform.value_at(t_set)
+
+            VI, VS = set_and_sense(sc, tip_idx, voltage)
+            t_meas = timer.elapsed()
+
+            stable = voltage == V_set_kept and abs(VS - VS_kept) <= stable_tolerance
+            if not stable or dense[tick] or t_set - t_kept >= max_gap:
+                measurements.append(t_set, t_meas, voltage, VI, VS, tip_idx)
+                t_kept, V_set_kept, VS_kept = t_set, voltage, VS
+            if stable and not dense[tick] and tick + 1 < len(times):
+                # The last tick within keepalive, so the next setpoint is not later than that.
+                keepalive_tick = max(tick + 1, int(np.searchsorted(times, t_set + keepalive, side='right')) - 1)
+                timer.skip_until(min(times[keepalive_tick], t_kept + max_gap, next_required[tick + 1]))
+            if writer is not None:
+                writer.maybe_flush(measurements)
+            timer.wait_next()
+        finished = True
+    finally:
+        _end_run(measurements, writer, timer, finished)
 
     print('Done')
-    return recorded_time, set_voltage, measurements
+    timer.print_stats()
+    return measurements
 
 
-def multi_box_t_on_variation(t_on: list[int], t_off: int, N_pulses: int, voltage_ampl: int, tip_idx: int, serial: object)-> list:
+def upload_waveform(waveform: waveforms.Waveform, tip_idx: int, serial: object, dT: float = 0.001) -> int:
+    """
+    Upload a waveform to the Arduino for run_waveform_uploaded() (see playback_protocol.py).
+
+    Returns the number of samples the Arduino will take (one every dT s until waveform.t_end).
+    """
+    sc = serial
+    capacity = int(sc.send_string('?WC', wait_for_answer=True).split(' ')[1])
+    if len(waveform) > capacity:
+        raise ValueError(f'The waveform has {len(waveform)} breakpoints, the Arduino takes at most {capacity}.')
+
+    answer = sc.send_string(f'!WL {tip_idx} {len(waveform)} {round(waveform.t_end*1e6)} {round(dT*1e6)}', wait_for_answer=True)
+    if not answer.startswith('!WL'):
+        raise RuntimeError(f'Upload of the waveform failed: {answer}')
+    # One line at a time, the receive buffer of the Arduino takes only one.
+    for line in playback_protocol.encode_table(waveform.breakpoints, waveform.values):
+        answer = sc.send_string(line, wait_for_answer=True)
+        if not answer.startswith('!WD'):
+            raise RuntimeError(f'Upload of the waveform failed at "{line}": {answer}')
+    return int(np.ceil(round(waveform.t_end*1e6) / round(dT*1e6)))
+
+
+def run_waveform_uploaded(waveform: waveforms.Waveform, tip_idx: int, serial: object, dT: float = 0.001,
+                          store: RunStore = None, metadata: dict = None, timeout: float = 1.0)-> MeasurementBuffer:
+    """
+    run_waveform() played by the Arduino: the waveform is uploaded first, then the Arduino sets and senses on its own
+    clock and sends the samples back in bursts (see playback_protocol.py). No round trip per sample, so dT can be
+    well below the latency of the serial connection, down to what the baud rate can carry: a sample is 8 hex
+    characters on the wire (4 bytes, plus about 12 characters per burst line), 10 bits per character, so about 240
+    samples per s at 19200 baud (dT >= 5 ms) and about 1400 at 115200 baud (dT >= 1 ms). The upload takes one round
+    trip per !WD line (as many breakpoints as fit in 64 bytes).
+
+    t_set and t_meas are the sample times of the Arduino (k*dT). Samples of bursts lost on the line are missing
+    (metadata['playback']['n_lost']).
+    :param timeout: time in s without any burst after which the playback counts as failed
+    """
     sc = serial
+    n_samples = upload_waveform(waveform, tip_idx, sc, dT)
+
+    metadata = dict(metadata) if metadata is not None else {}
+    metadata.update(tip_idx=tip_idx, dT=dT, port=getattr(sc, 'port', None), t_end=waveform.t_end, mode='uploaded')
+    measurements = MeasurementBuffer(capacity=n_samples, metadata=metadata)
+    writer = store.new_run(metadata) if store is not None else None
+    if writer is not None:
+        measurements.metadata['run_id'] = writer.metadata['run_id']
+
+    n_late = 0
+    finished = False
+    answer = sc.send_string(f'!WP {tip_idx}', wait_for_answer=True)
+    if not answer.startswith('!WP'):
+        raise RuntimeError(f'Playback of the waveform failed: {answer}')
+    t_last_burst = time.perf_counter()
+    try:
+        while not finished:
+            lines = sc.readlines()
+            if not lines and time.perf_counter() - t_last_burst > timeout:
+                raise TimeoutError(f'No samples from port {sc.port} for {timeout} s.')
+            for line in lines:
+                line = str(line, 'ascii', 'replace').strip()
+                if line.startswith('#S'):
+                    try:
+                        i, samples = playback_protocol.decode_samples(line)
+                    except ValueError:
+                        continue
+                    t = dT*np.arange(i, i + len(samples))
+                    measurements.extend(t, t, waveform.values_at(t), samples['V_in'], samples['V_sense'], tip_idx)
+                    t_last_burst = time.perf_counter()
+                elif line.startswith('#WE'):
+                    n_late = int(line.split(' ')[2])
+                    finished = True
+            if writer is not None:
+                writer.maybe_flush(measurements)
+    finally:
+        if not finished:
+            # Interrupted (or no answer): stop the playback, V-in goes to 0. The rest of the bursts is discarded.
+            sc.send_string('!WS')
+            t_stop = time.perf_counter() + timeout
+            while time.perf_counter() < t_stop and not any(str(line, 'ascii', 'replace').startswith('!WS') for line in sc.readlines()):
+                pass
+        n_lost = n_samples - len(measurements)
+        measurements.metadata['playback'] = {'n_samples': n_samples, 'n_lost': n_lost, 'n_late': n_late}
+        if writer is not None:
+            writer.close(measurements, {'playback': measurements.metadata['playback'], 'interrupted': not finished})
+
+    print(f'Done: {len(measurements)} of {n_samples} samples, {n_late} late')
+    return measurements
+
+
+def _start_run(t_end, tip_idx, sc, dT, missed_tick_policy, store, metadata, times=None) -> tuple:
+    """
+    Buffer, run writer (None without a store) and started scheduler of a run.
+
+    tip_idx can be a list of tips (run_waveforms()), the buffer then has a row per tip and tick.
+    With times (adaptive sampling), the ticks are at these times instead of every dT.
+    """
+    n_tips = len(tip_idx) if isinstance(tip_idx, list) else 1
+    metadata = dict(metadata) if metadata is not None else {}
+    metadata.update(tip_idx=tip_idx, dT=dT, port=getattr(sc, 'port', None), t_end=t_end)
+
+    # Preallocated for the whole run (with some margin), the loop itself allocates no lists.
+    n_ticks = len(times) if times is not None else int(1.1*t_end/dT) + 16
+    measurements = MeasurementBuffer(capacity=n_tips*n_ticks, metadata=metadata)
+    writer = store.new_run(metadata) if store is not None else None
+    if writer is not None:
+        measurements.metadata['run_id'] = writer.metadata['run_id']
+
+    timer = DeadlineScheduler(dT, missed_tick_policy) if times is None else TimeTableScheduler(times, missed_tick_policy)
+    timer.start()
+    return measurements, writer, timer
+
+
+def _end_run(measurements, writer, timer, finished: bool):
+    measurements.metadata['timing'] = timer.stats()
+    if writer is not None:
+        # Also on an interrupt (KeyboardInterrupt in the notebook), the samples so far are kept.
+        writer.close(measurements, {'timing': measurements.metadata['timing'], 'interrupted': not finished})
+
+
+# ------------------------------------------------------------------------------
+# Profiles. Every profile compiles its waveform and the metadata of the run (with the per-pulse sequences expanded).
+
+def _box(t_on, voltage_ampl) -> tuple:
+    metadata = {'profile': 'box', 't_on': t_on, 'voltage_ampl': voltage_ampl}
+    return waveforms.box(t_on, voltage_ampl), metadata
+
+
+def _multi_box(t_on, t_off, N_pulses, voltage_ampl) -> tuple:
+    metadata = {'profile': 'multi_box', 't_on': t_on, 't_off': t_off, 'N_pulses': N_pulses, 'voltage_ampl': voltage_ampl}
+    return waveforms.multi_box(t_on, t_off, N_pulses, voltage_ampl), metadata
+
+
+def _multi_box_ampl_variation(t_on, t_off, N_pulses, voltage_ampl) -> tuple:
+    # voltage_ampl: [V_min, V_max] is linearly interpolated, a too short sequence is continued with its last value.
+    waveform = waveforms.multi_box_ampl_variation(t_on, t_off, N_pulses, voltage_ampl)
+    voltage_ampl_sequence = waveform.values[0::2].tolist()
+    print(voltage_ampl_sequence)
+    metadata = {'profile': 'multi_box_ampl_variation', 't_on': t_on, 't_off': t_off, 'N_pulses': N_pulses, 'voltage_ampl': voltage_ampl_sequence}
+    return waveform, metadata
+
+
+def _multi_box_t_on_variation(t_on, t_off, N_pulses, voltage_ampl) -> tuple:
+    # t_on: [t_on_min, t_on_max] is linearly interpolated, a too short sequence is continued with its last value.
+    t_on_sequence = waveforms.expand_sequence(t_on, N_pulses)
+    waveform = waveforms.multi_box_t_on_variation(t_on_sequence, t_off, N_pulses, voltage_ampl)
+    metadata = {'profile': 'multi_box_t_on_variation', 't_on': t_on_sequence, 't_off': t_off, 'N_pulses': N_pulses, 'voltage_ampl': voltage_ampl}
+    return waveform, metadata
+
+
+def box(t_on: int, voltage_ampl: int, tip_idx: int, serial: object, dT: float = 0.05, store: RunStore = None)-> MeasurementBuffer:
+    waveform, metadata = _box(t_on, voltage_ampl)
+    return run_waveform(waveform, tip_idx, serial, dT, store=store, metadata=metadata)
+
+
+def multi_box(t_on: int, t_off: int, N_pulses: int, voltage_ampl: int, tip_idx: int, serial: object, dT: float = 0.05, store: RunStore = None)-> MeasurementBuffer:
+    waveform, metadata = _multi_box(t_on, t_off, N_pulses, voltage_ampl)
+    return run_waveform(waveform, tip_idx, serial, dT, store=store, metadata=metadata)
 
-    dT = 0.05 # Approximate time resolution (loop time)
-    measurements = []
-    recorded_time = []
-    set_voltage = []
-
-    t_start = time.time()
-    timer_loop_time = time.time()
-
-    # if only V_min and V_max are given, linearly interpolate
-    if len(t_on) == 2:
-        t_on_sequence = [voltage_ampl[0] + i*(voltage_ampl[1]-voltage_ampl[0])//(N_pulses-1) for i in range(N_pulses)]
-        t_on = t_on_sequence
-    
-    # if voltage is given as a lits, but too short, repeat pulses with the last voltage amplitude
-    elif len(t_on) < N_pulses:
-        for i in range(N_pulses- len(t_on)):
-            t_on.append(t_on[-1])
-
-    t_recording_stop = t_signal_start + sum(t_on) + N_pulses*t_off + 3
-    while time.time() < t_start + t_recording_stop:
-        t = time.time() - t_start
-        recorded_time.append(t)
-
-        for t in np.linspace(0, 10, 20):
-            cycle = sum([t - t_signal_start > sum(t_on[:i]) + i*t_off for i in range(N_pulses)])-1
-            if sum(t_on[:cycle]) + cycle*t_off < t - t_signal_start < sum(t_on[:cycle+1]) + cycle*t_off:
-                voltage = voltage_ampl
-            else: 
-                voltage = 0
-
-        set_voltage.append(voltage)
-
-        # Send control voltage to Arduino - Vin
-        a = sc.send_string(f"!SI {tip_idx} " + str(voltage), wait_for_answer=True)
-        VI = int(a.split(' ')[2])
-        
-        # Read the voltage measurement - Vsense
-        a = sc.send_string(f'?SS {tip_idx}', wait_for_answer=True)
-        VS = int(a.split(' ')[1])
-        t = time.time() - t_start
-
-        measurements.append([t, VI, VS])
-        while time.time() < timer_loop_time + dT:
-            time.sleep(0.0001)
-        timer_loop_time = time.time()
 
-    print('Done')
-    return recorded_time, set_voltage, measurements
+def multi_box_ampl_variation(t_on: int, t_off: int, N_pulses: int, voltage_ampl: list[int], tip_idx: int, serial: object, dT: float = 0.05, store: RunStore = None)-> MeasurementBuffer:
+    waveform, metadata = _multi_box_ampl_variation(t_on, t_off, N_pulses, voltage_ampl)
+    return run_waveform(waveform, tip_idx, serial, dT, store=store, metadata=metadata)
+
+
+def multi_box_t_on_variation(t_on: list[int], t_off: int, N_pulses: int, voltage_ampl: int, tip_idx: int, serial: object, dT: float = 0.05, store: RunStore = None)-> MeasurementBuffer:
+    waveform, metadata = _multi_box_t_on_variation(t_on, t_off, N_pulses, voltage_ampl)
+    return run_waveform(waveform, tip_idx, serial, dT, store=store, metadata=metadata)
+
+
+def multi_box_adaptive(t_on: int, t_off: int, N_pulses: int, voltage_ampl: int, tip_idx: int, serial: object, dT_edge: float = 0.005,
+                       dT_plateau: float = 0.05, store: RunStore = None, **adaptive)-> MeasurementBuffer:
+    """multi_box() with adaptive sampling (see run_waveform_adaptive() for the other parameters)."""
+    waveform, metadata = _multi_box(t_on, t_off, N_pulses, voltage_ampl)
+    return run_waveform_adaptive(waveform, tip_idx, serial, dT_edge, dT_plateau, store=store, metadata=metadata, **adaptive)
+
+
+async def multi_box_async(t_on: int, t_off: int, N_pulses: int, voltage_ampl: int, tip_idx: int, serial: object, dT: float = 0.05, store: RunStore = None)-> MeasurementBuffer:
+    waveform, metadata = _multi_box(t_on, t_off, N_pulses, voltage_ampl)
+    return await run_waveform_async(waveform, tip_idx, serial, dT, store=store, metadata=metadata)
+
 
+async def multi_box_ampl_variation_async(t_on: int, t_off: int, N_pulses: int, voltage_ampl: list[int], tip_idx: int, serial: object, dT: float = 0.05, store: RunStore = None)-> MeasurementBuffer:
+    waveform, metadata = _multi_box_ampl_variation(t_on, t_off, N_pulses, voltage_ampl)
+    return await run_waveform_async(waveform, tip_idx, serial, dT, store=store, metadata=metadata)
 
 
+async def multi_box_t_on_variation_async(t_on: list[int], t_off: int, N_pulses: int, voltage_ampl: int, tip_idx: int, serial: object, dT: float = 0.05, store: RunStore = None)-> MeasurementBuffer:
+    waveform, metadata = _multi_box_t_on_variation(t_on, t_off, N_pulses, voltage_ampl)
+    return await run_waveform_async(waveform, tip_idx, serial, dT, store=store, metadata=metadata)
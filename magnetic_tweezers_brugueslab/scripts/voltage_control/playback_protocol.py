@@ -0,0 +1,94 @@
+'''
+Upload-and-play mode of the voltage control Arduino: the whole waveform is uploaded before the run and played by the
+Arduino on its own clock, the samples come back in bursts. The time resolution then depends on the Arduino (DAC, ADC
+and its timer), not on the round trips to the PC and the scheduling of Python (see my_funcs.run_waveform_uploaded()).
+
+Protocol (ASCII lines like the other commands: the PC ends them with '\\r', the Arduino with '\\r\\n'; a line from the
+PC is at most max_line_length = 64 bytes with the '\\r', the size of the receive buffer of the Arduino):
+
+    ?WC                         capacity of the table                           -> '?WC n_max'
+    !WL tip n t_end dt          start loading a table of n breakpoints for tip, -> '!WL tip n'
+                                played for t_end us with a sample every dt us
+    !WD i t v [t v ...]         breakpoints i, i+1, ... of the table:           -> '!WD i k' (k breakpoints stored)
+                                time t in us from the start, V-in v in mV
+    !WP tip                     play the table of tip                           -> '!WP tip n_samples'
+    !WS                         stop playing (answered after '#WE')             -> '!WS tip'
+
+The table is the compiled waveform (see waveforms.Waveform): v holds from t to the next breakpoint, 0 mV before the
+first one. The breakpoints are sent in order, as many as fit in a line, every line is answered before the next one is
+sent. Errors (unknown command, line too long, table too long, breakpoint out of order, !WP without a complete table)
+are answered with 'E <command>'.
+
+While playing, sample k is taken at k*dt us after !WP (k = 0 ... n_samples-1, n_samples = ceil(t_end/dt)): V-in is
+set to the value of the table at that time (clamped to Vmax like !SI) and V-sense is read. The samples are sent in
+bursts, one line for every few samples (as many as the Arduino likes, at most 32):
+
+    #S i hex cs                 samples i, i+1, ...: hex is 8 hex digits (4 bytes) per sample, V-in and V-sense as
+                                int16 little endian, cs the sum of these bytes modulo 256 (2 hex digits)
+    #WE n_samples n_late        end of the playback (also after !WS); n_late: samples taken late because the
+                                Arduino was busy (for example sending)
+
+After the playback V-in of the tip is 0. Commands other than !WS during the playback are answered with 'E <command>'.
+
+Example (one pulse of 1000 mV from 2 ms to 5 ms, 10 ms recorded with a sample every 500 us):
+    PC: !WL 0 2 10000 500   ->  !WL 0 2
+    PC: !WD 0 2000 1000 5000 0  ->  !WD 0 2
+    PC: !WP 0               ->  !WP 0 20
+                                #S 0 0000000000000000...
+                                #S 16 ...
+                                #WE 20 0
+'''
+
+import numpy as np
+
+
+max_line_length = 64  # bytes of a line from the PC, with the terminator
+sample_dtype = np.dtype([('V_in', '<i2'), ('V_sense', '<i2')])
+
+
+def encode_table(breakpoints, values) -> list:
+    """
+    !WD lines of a table (breakpoints in s), each with as many (t, v) pairs as fit in max_line_length (with the
+    terminator).
+
+    Raises ValueError if a single breakpoint does not fit in a line.
+    """
+    t_us = np.rint(np.asarray(breakpoints, dtype=float) * 1e6).astype(np.int64)
+    values = np.asarray(values, dtype=int)
+    lines = []
+    line = None
+    for i, (t, v) in enumerate(zip(t_us.tolist(), values.tolist())):
+        pair = f' {t} {v}'
+        if line is not None and len(line) + len(pair) + 1 <= max_line_length:
+            line += pair
+            continue
+        if line is not None:
+            lines.append(line)
+        line = f'!WD {i}{pair}'
+        if len(line) + 1 > max_line_length:
+            raise ValueError(f'Breakpoint {i} ({t} us, {v} mV) does not fit in a line of {max_line_length} bytes.')
+    if line is not None:
+        lines.append(line)
+    return lines
+
+
+def encode_samples(first_index: int, v_in, v_sense) -> str:
+    """#S line of a burst (the Arduino side, for the virtual device)."""
+    samples = np.empty(len(v_in), dtype=sample_dtype)
+    samples['V_in'] = v_in
+    samples['V_sense'] = v_sense
+    payload = samples.tobytes()
+    return f'#S {first_index} {payload.hex()} {sum(payload) & 0xFF:02x}'
+
+
+def decode_samples(line: str) -> tuple:
+    """
+    Decode a #S line to (index of the first sample, samples with sample_dtype).
+
+    Raises ValueError if the line is corrupted (wrong length or checksum).
+    """
+    _, first_index, payload, checksum = line.split(' ')
+    payload = bytes.fromhex(payload)
+    if len(payload) % sample_dtype.itemsize or (sum(payload) & 0xFF) != int(checksum, 16):
+        raise ValueError(f'Corrupted burst: {line}')
+    return int(first_index), np.frombuffer(payload, dtype=sample_dtype)
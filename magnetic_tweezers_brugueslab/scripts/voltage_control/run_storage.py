@@ -0,0 +1,171 @@
+'''
+Streaming storage of the measurements on disk.
+
+A RunStore is a directory (for example one per session). Every run gets two files:
+    run_00012.bin  - the samples, raw records of measurement_dtype, appended in chunks during the run
+    run_00012.json - metadata of the run (profile parameters, port, tip_idx, ...), n_samples and whether it completed
+and the metadata of every completed run is appended to index.jsonl, so the runs can be searched (find()) without
+opening every file.
+The data is written while the run goes, so a crash of the kernel loses at most the last flush_interval seconds.
+Runs are read back lazily as memory maps, without loading the whole session.
+'''
+
+import os
+import json
+import time
+import numpy as np
+
+from measurement_buffer import MeasurementBuffer, measurement_dtype
+
+
+def _to_json(x):
+    # NumPy scalars and arrays in the metadata.
+    if isinstance(x, np.generic):
+        return x.item()
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    return str(x)
+
+
+def _json_value(x):
+    # The value as it comes back from the JSON metadata (tuples and arrays as lists).
+    return json.loads(json.dumps(x, default=_to_json))
+
+
+class RunWriter:
+    def __init__(self, path: str, metadata: dict, flush_interval: float = 1.0, index_path: str = None) -> None:
+        """
+        Writer of one run. Use RunStore.new_run() to create it.
+
+        :param path: path of the run files without the extension
+        :param flush_interval: maximal time in s between two writes to disk during the run
+        :param index_path: index of the store, the metadata is appended to it when the run is closed
+        """
+        self.path = path
+        self.metadata = dict(metadata)
+        self.flush_interval = flush_interval
+        self.index_path = index_path
+
+        self.n_written = 0
+        self._file = open(path + '.bin', 'wb')
+        self._t_last_flush = time.perf_counter()
+        self._write_metadata(complete=False)
+
+    def maybe_flush(self, buffer: MeasurementBuffer):
+        """Write the new samples of the buffer if the last write was more than flush_interval ago (cheap otherwise)."""
+        if time.perf_counter() - self._t_last_flush >= self.flush_interval:
+            self.flush(buffer)
+
+    def flush(self, buffer: MeasurementBuffer):
+        """Append the samples of the buffer that are not on disk yet."""
+        if len(buffer) > self.n_written:
+            chunk = np.empty(len(buffer) - self.n_written, dtype=measurement_dtype)
+            for name in measurement_dtype.names:
+                chunk[name] = buffer[name][self.n_written:]
+            self._file.write(chunk.tobytes())
+            self._file.flush()
+            self.n_written = len(buffer)
+        self._t_last_flush = time.perf_counter()
+
+    def close(self, buffer: MeasurementBuffer = None, metadata: dict = None):
+        """Write the rest of the buffer and mark the run as complete (metadata is added to the run metadata)."""
+        if buffer is not None:
+            self.flush(buffer)
+        self._file.close()
+        if metadata is not None:
+            self.metadata.update(metadata)
+        self._write_metadata(complete=True)
+        if self.index_path is not None:
+            with open(self.index_path, 'a') as f:
+                f.write(json.dumps(dict(self.metadata, n_samples=self.n_written, complete=True), default=_to_json) + '\n')
+
+    def _write_metadata(self, complete: bool):
+        metadata = dict(self.metadata, n_samples=self.n_written, complete=complete)
+        # Write to a temporary file and rename it, so the metadata on disk is never half written.
+        with open(self.path + '.json.tmp', 'w') as f:
+            json.dump(metadata, f, indent=1, default=_to_json)
+        os.replace(self.path + '.json.tmp', self.path + '.json')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if not self._file.closed:
+            self.close()
+
+
+class RunStore:
+    def __init__(self, directory: str) -> None:
+        """Directory with the runs of a session (created if it does not exist)."""
+        self.directory = directory
+        self._index_path = os.path.join(directory, 'index.jsonl')
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, run_id: int) -> str:
+        return os.path.join(self.directory, f'run_{run_id:05}')
+
+    def runs(self) -> list:
+        """Ids of the runs in the store, in the order they were recorded."""
+        return sorted(int(f[4:9]) for f in os.listdir(self.directory) if f.startswith('run_') and f.endswith('.json'))
+
+    def new_run(self, metadata: dict = None, flush_interval: float = 1.0) -> RunWriter:
+        runs = self.runs()
+        run_id = runs[-1] + 1 if runs else 0
+        metadata = dict(metadata) if metadata is not None else {}
+        metadata.update(run_id=run_id, t_start=time.strftime('%Y-%m-%d %H:%M:%S'))
+        return RunWriter(self._path(run_id), metadata, flush_interval, self._index_path)
+
+    def index(self) -> list:
+        """Metadata of all the completed runs (from index.jsonl, rebuilt from the run files if it is missing)."""
+        if not os.path.exists(self._index_path):
+            self.rebuild_index()
+        entries = {}
+        with open(self._index_path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries[entry['run_id']] = entry
+        return [entries[run_id] for run_id in sorted(entries)]
+
+    def rebuild_index(self):
+        """Write index.jsonl again from the metadata files of the completed runs."""
+        with open(self._index_path + '.tmp', 'w') as f:
+            for run_id in self.runs():
+                metadata = self.metadata(run_id)
+                if metadata.get('complete'):
+                    f.write(json.dumps(metadata) + '\n')
+        os.replace(self._index_path + '.tmp', self._index_path)
+
+    def find(self, **criteria) -> list:
+        """
+        Ids of the completed runs whose metadata has the given values, for example
+            store.find(profile='multi_box', t_on=5, tip_idx=0)
+        Interrupted runs are included (their metadata has interrupted=True).
+        """
+        return [entry['run_id'] for entry in self.index()
+                if all(key in entry and entry[key] == _json_value(value) for key, value in criteria.items())]
+
+    def metadata(self, run_id: int) -> dict:
+        with open(self._path(run_id) + '.json') as f:
+            return json.load(f)
+
+    def load(self, run_id: int) -> np.ndarray:
+        """
+        Samples of a run as a read only memory map (structured array with measurement_dtype).
+
+        Only the parts that are accessed are read from disk. Also works for a run that is still being written or was
+        interrupted (it contains the samples written so far).
+        """
+        path = self._path(run_id) + '.bin'
+        if os.path.getsize(path) < measurement_dtype.itemsize:
+            return np.empty(0, dtype=measurement_dtype)
+        n_samples = os.path.getsize(path) // measurement_dtype.itemsize
+        return np.memmap(path, dtype=measurement_dtype, mode='r', shape=(n_samples,))
+
+    def __len__(self):
+        return len(self.runs())
+
+    def __iter__(self):
+        """Iterate over (metadata, samples) of all runs (the samples are loaded lazily)."""
+        for run_id in self.runs():
+            yield self.metadata(run_id), self.load(run_id)
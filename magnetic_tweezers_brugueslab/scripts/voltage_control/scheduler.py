@@ -0,0 +1,193 @@
+'''
+Tick scheduler for the control loops in my_funcs.py.
+
+Ticks are at absolute deadlines t0 + k*dT on the monotonic perf_counter_ns() clock, so the overrun of one tick does
+not shift the following ones and wall clock jumps do not matter. The wait sleeps coarsely until shortly before the
+deadline and then waits the rest out finely.
+'''
+
+import time
+import asyncio
+import numpy as np
+
+
+# Bin edges of the lateness histogram in ms (lateness = how late the tick started after its deadline).
+lateness_bin_edges_ms = [0, 0.1, 0.5, 1, 2, 5, 10, 20, 50, np.inf]
+
+
+class DeadlineScheduler:
+    def __init__(self, dT: float, missed_tick_policy: str = 'skip', fine_wait_time: float = 0.002) -> None:
+        """
+        :param dT: tick period in s
+        :param missed_tick_policy: what to do when a tick is late by more than a whole period.
+                'skip' - continue with the next deadline in the future (the missed ticks are dropped),
+                'catch_up' - keep all the deadlines, the late ticks run back to back until the loop is on time again.
+        :param fine_wait_time: time in s before the deadline at which the coarse sleep stops and the fine wait starts.
+                It should be larger than the sleep granularity of the OS (~1-2 ms on Windows with high res timers).
+        """
+        if missed_tick_policy not in ('skip', 'catch_up'):
+            raise ValueError(f'Unknown missed_tick_policy "{missed_tick_policy}". Use "skip" or "catch_up".')
+        self.dT = dT
+        self.missed_tick_policy = missed_tick_policy
+        self.fine_wait_time = fine_wait_time
+
+        self.dT_ns = int(round(dT * 1e9))
+        self.fine_wait_time_ns = int(fine_wait_time * 1e9)
+
+        self.t0_ns = None
+        self.tick = 0
+        self.n_missed = 0
+        self._lateness_ns = np.zeros(1024, dtype=np.int64)
+        self._n_lateness = 0
+
+    def start(self):
+        """Start the timebase. The first deadline is one dT later."""
+        self.t0_ns = time.perf_counter_ns()
+        self.tick = 0
+        self.n_missed = 0
+        self._n_lateness = 0
+
+    def elapsed(self) -> float:
+        """Time in s since start()."""
+        return (time.perf_counter_ns() - self.t0_ns) * 1e-9
+
+    def wait_next(self) -> int:
+        """
+        Wait for the next deadline and return the index of the tick that starts now.
+        """
+        deadline_ns, now_ns = self._next_deadline()
+
+        # Coarse sleep, then the fine wait.
+        remaining_ns = deadline_ns - now_ns
+        if remaining_ns > self.fine_wait_time_ns:
+            time.sleep((remaining_ns - self.fine_wait_time_ns) * 1e-9)
+        now_ns = time.perf_counter_ns()
+        while now_ns < deadline_ns:
+            time.sleep(0)
+            now_ns = time.perf_counter_ns()
+
+        self._record_lateness(now_ns - deadline_ns)
+        return self.tick
+
+    async def wait_next_async(self) -> int:
+        """
+        wait_next() for asyncio: the other tasks run while waiting.
+
+        There is no fine wait (it would block the event loop), so the lateness is limited by the resolution of
+        the event loop timer (~1 ms on Linux and macOS, up to ~15 ms on Windows).
+        """
+        deadline_ns, now_ns = self._next_deadline()
+        if deadline_ns > now_ns:
+            await asyncio.sleep((deadline_ns - now_ns) * 1e-9)
+        else:
+            await asyncio.sleep(0)
+        self._record_lateness(time.perf_counter_ns() - deadline_ns)
+        return self.tick
+
+    def _next_deadline(self) -> tuple:
+        """Advance to the next tick (applying missed_tick_policy). Returns its deadline and the current time in ns."""
+        self.tick += 1
+        deadline_ns = self.t0_ns + self.tick * self.dT_ns
+        now_ns = time.perf_counter_ns()
+
+        if now_ns - deadline_ns >= self.dT_ns and self.missed_tick_policy == 'skip':
+            # One or more whole ticks were missed. Continue on the grid with the next deadline in the future.
+            next_tick = (now_ns - self.t0_ns) // self.dT_ns + 1
+            self.n_missed += next_tick - self.tick
+            self.tick = next_tick
+            deadline_ns = self.t0_ns + self.tick * self.dT_ns
+        return deadline_ns, now_ns
+
+    def _record_lateness(self, lateness_ns: int):
+        if self._n_lateness == len(self._lateness_ns):
+            self._lateness_ns = np.concatenate((self._lateness_ns, np.zeros_like(self._lateness_ns)))
+        self._lateness_ns[self._n_lateness] = lateness_ns
+        self._n_lateness += 1
+
+    def stats(self) -> dict:
+        """
+        Statistics of the run so far.
+
+        Returns a dictionary with the number of ticks, the number of missed (skipped) ticks, the achieved and the
+        requested rate in Hz, the mean, p99 and max lateness in ms and the lateness histogram (counts per bin of
+        lateness_bin_edges_ms).
+        """
+        lateness_ms = self._lateness_ns[:self._n_lateness] * 1e-6
+        t_run = self.elapsed() if self.t0_ns is not None else 0
+        counts, _ = np.histogram(lateness_ms, bins=lateness_bin_edges_ms)
+        return {
+            'n_ticks': self._n_lateness,
+            'n_missed': self.n_missed,
+            'rate': self._n_lateness / t_run if t_run > 0 else 0,
+            'rate_requested': 1 / self.dT,
+            'lateness_mean_ms': float(lateness_ms.mean()) if len(lateness_ms) else 0,
+            'lateness_p99_ms': float(np.percentile(lateness_ms, 99)) if len(lateness_ms) else 0,
+            'lateness_max_ms': float(lateness_ms.max()) if len(lateness_ms) else 0,
+            'lateness_histogram': counts.tolist(),
+            'lateness_bin_edges_ms': lateness_bin_edges_ms,
+        }
+
+    def print_stats(self):
+        s = self.stats()
+        print(f"{s['n_ticks']} ticks at {s['rate']:.1f} Hz (requested {s['rate_requested']:.1f} Hz), "
+              f"{s['n_missed']} missed. Lateness: mean {s['lateness_mean_ms']:.2f} ms, "
+              f"p99 {s['lateness_p99_ms']:.2f} ms, max {s['lateness_max_ms']:.2f} ms")
+        edges = s['lateness_bin_edges_ms']
+        for i, count in enumerate(s['lateness_histogram']):
+            print(f'    {edges[i]:>5} - {edges[i+1]:<5} ms: {count}')
+
+
+class TimeTableScheduler(DeadlineScheduler):
+    def __init__(self, times, missed_tick_policy: str = 'skip', fine_wait_time: float = 0.002) -> None:
+        """
+        DeadlineScheduler with ticks at given times instead of every dT (for adaptive sampling, see
+        waveforms.adaptive_sample_times()). Tick k is at t0 + times[k]; tick 0 is right at start().
+
+        :param times: increasing times in s from the start, times[0] = 0
+        :param missed_tick_policy: see DeadlineScheduler; 'skip' continues with the first time in the future
+        """
+        times = np.asarray(times, dtype=float)
+        super().__init__(float(np.min(np.diff(times))) if len(times) > 1 else 1.0, missed_tick_policy, fine_wait_time)
+        self.times_ns = np.rint(times * 1e9).astype(np.int64)
+        self.n_skipped = 0
+
+    def start(self):
+        super().start()
+        self.n_skipped = 0
+
+    def skip_until(self, t: float):
+        """
+        Leave out the ticks before t (s from the start): the next wait_next() waits for the first tick at or after t.
+        With t = inf all the remaining ticks are left out.
+        """
+        if not np.isfinite(t):
+            next_tick = len(self.times_ns)
+        else:
+            next_tick = int(np.searchsorted(self.times_ns, int(t * 1e9), side='left'))
+        if next_tick - 1 > self.tick:
+            self.n_skipped += next_tick - 1 - self.tick
+            self.tick = next_tick - 1
+
+    def _next_deadline(self) -> tuple:
+        self.tick += 1
+        now_ns = time.perf_counter_ns()
+        if self.tick >= len(self.times_ns):
+            # After the last time: right away (the loop ends there).
+            return now_ns, now_ns
+        deadline_ns = self.t0_ns + self.times_ns[self.tick]
+
+        if self.missed_tick_policy == 'skip' and self.tick + 1 < len(self.times_ns) \
+                and now_ns >= self.t0_ns + self.times_ns[self.tick + 1]:
+            # Late past the next tick as well: continue with the first tick in the future.
+            next_tick = min(int(np.searchsorted(self.times_ns, now_ns - self.t0_ns, side='right')), len(self.times_ns) - 1)
+            self.n_missed += next_tick - self.tick
+            self.tick = next_tick
+            deadline_ns = self.t0_ns + self.times_ns[self.tick]
+        return int(deadline_ns), now_ns
+
+    def stats(self) -> dict:
+        """DeadlineScheduler.stats(), the requested rate is the mean rate of the time table, plus n_skipped."""
+        s = super().stats()
+        s['rate_requested'] = len(self.times_ns) / (self.times_ns[-1] * 1e-9) if self.times_ns[-1] > 0 else 0
+        s['n_skipped'] = self.n_skipped
+        return s
@@ -0,0 +1,117 @@
+'''
+Parameter sweeps: a grid of profile parameters (and tips) expanded into a queue of runs that are run back to back
+on the same connection, every run into the same RunStore.
+
+The queue and the progress are checkpointed in the store (sweep_<name>.json, written after every run), so after an
+interruption or a crash of the kernel the same Sweep continues with the runs that are not done yet:
+
+    sweep = Sweep(store, 'ampl_t_on', base={'profile': 'multi_box_ampl_variation', 't_off': 15, 'N_pulses': 7},
+                  grid={'t_on': [2, 5], 'voltage_ampl': [[500, 2000], [1000, 3000]], 'tip_idx': [0, 1]}, repeats=3)
+    sweep.run(sc)          # again after an interruption: continues where it stopped
+    store.find(sweep='ampl_t_on', t_on=5)   # run ids
+
+A run that was interrupted is run again from its start (the interrupted one stays in the store, not done).
+'''
+
+import os
+import json
+import time
+import itertools
+
+import my_funcs
+import waveforms
+from run_storage import RunStore, _json_value
+
+
+class Sweep:
+    def __init__(self, store: RunStore, name: str, base: dict, grid: dict, repeats: int = 1, dT: float = 0.05) -> None:
+        """
+        :param store: RunStore of the runs and of the checkpoint
+        :param name: name of the sweep (the checkpoint is found by it)
+        :param base: parameters of all the runs: 'profile' and its parameters (see waveforms.profiles), tip_idx
+        :param grid: parameter -> list of values; every combination is a run (tip_idx can be swept as well). A value
+                     can itself be a sequence, for example [V_min, V_max] of voltage_ampl.
+        :param repeats: number of runs of every combination
+        :param dT: time step of the control loop in s
+        """
+        self.store = store
+        self.name = name
+        self.dT = dT
+        self.path = os.path.join(store.directory, f'sweep_{name}.json')
+
+        # As they come back from the checkpoint (NumPy values of the grid as Python numbers, tuples as lists).
+        planned = _json_value(self._expand(base, grid, repeats))
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                checkpoint = json.load(f)
+            if [run['parameters'] for run in checkpoint['runs']] != planned:
+                raise ValueError(f'The sweep "{name}" in {store.directory} has other parameters. Use another name.')
+            self.runs = checkpoint['runs']
+        else:
+            self.runs = [{'parameters': parameters, 'run_id': None} for parameters in planned]
+            self._write_checkpoint()
+
+        # Compiled now, so a wrong parameter fails before the first run and not in the middle of the sweep.
+        self._waveforms = [self._compile(run['parameters']) if run['run_id'] is None else None for run in self.runs]
+
+    @staticmethod
+    def _expand(base, grid, repeats) -> list:
+        names = list(grid)
+        runs = []
+        for values in itertools.product(*(grid[name] for name in names)):
+            parameters = dict(base, **dict(zip(names, values)))
+            runs += [dict(parameters, repeat=i) for i in range(repeats)]
+        if any('profile' not in run or 'tip_idx' not in run for run in runs):
+            raise ValueError('Every run needs a profile and a tip_idx (in base or grid).')
+        return runs
+
+    @staticmethod
+    def _compile(parameters) -> waveforms.Waveform:
+        spec = {key: value for key, value in parameters.items() if key not in ('tip_idx', 'repeat')}
+        # Lists from the grid or the checkpoint are copied, the profile functions get their own.
+        return waveforms.compile_profile(json.loads(json.dumps(spec)))
+
+    def pending(self) -> list:
+        """Indices of the runs that are not done yet."""
+        return [i for i, run in enumerate(self.runs) if run['run_id'] is None]
+
+    def run(self, serial: object, pause: float = 0.0, runner=None) -> list:
+        """
+        Run the pending runs, in order. Returns the run ids of all the done runs of the sweep.
+
+        :param serial: serialConnection (used for all the runs, it stays open)
+        :param pause: time in s between two runs
+        :param runner: runner(waveform, tip_idx, serial, store=..., metadata=...) returning the MeasurementBuffer,
+                       default: my_funcs.run_waveform with dT
+        """
+        if runner is None:
+            runner = lambda waveform, tip_idx, serial, **kwargs: my_funcs.run_waveform(waveform, tip_idx, serial, self.dT, **kwargs)
+        pending = self.pending()
+        for n, i in enumerate(pending):
+            parameters = self.runs[i]['parameters']
+            print(f'Sweep {self.name}: run {i + 1} of {len(self.runs)} ({n + 1} of {len(pending)} left at the start): {parameters}')
+            metadata = dict(parameters, sweep=self.name, sweep_index=i)
+            measurements = runner(self._waveforms[i], parameters['tip_idx'], serial, store=self.store, metadata=metadata)
+            # Only a finished run counts (an interrupt raises out of the runner before this).
+            self.runs[i]['run_id'] = measurements.metadata['run_id']
+            self._waveforms[i] = None
+            self._write_checkpoint()
+            if pause and n + 1 < len(pending):
+                time.sleep(pause)
+        return self.run_ids()
+
+    def run_ids(self) -> list:
+        return [run['run_id'] for run in self.runs if run['run_id'] is not None]
+
+    def results(self):
+        """Iterate over (parameters, samples) of the done runs (the samples are loaded lazily, see RunStore.load())."""
+        for run in self.runs:
+            if run['run_id'] is not None:
+                yield run['parameters'], self.store.load(run['run_id'])
+
+    def _write_checkpoint(self):
+        checkpoint = {'name': self.name, 'dT': self.dT, 'runs': self.runs}
+        # Write to a temporary file and rename it, so a crash never leaves a half written checkpoint.
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(checkpoint, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
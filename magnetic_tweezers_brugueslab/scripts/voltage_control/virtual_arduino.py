@@ -0,0 +1,227 @@
+'''
+Virtual voltage control Arduino on a pseudo terminal (see virtual_device.py).
+
+Speaks the commands used by my_funcs.py and the notebook:
+    !SI tip V   set V-in of a tip (mV, clamped to Vmax)     -> '!SI tip V'
+    ?SS tip     read V-sense of a tip (mV)                  -> '?SS V'
+    !VM V       set Vmax                                    -> '!VM V'
+    !TT ms      set the auto timeout time                   -> '!TT ms'
+    !TO 0/1     auto timeout on/off (V-in goes to 0 after   -> '!TO 0/1'
+                the timeout without commands)
+    !PA 0/1     print all                                   -> '!PA 0/1'
+and the upload-and-play mode of playback_protocol.py (?WC, !WL, !WD, !WP, !WS; ASCII protocol only).
+Unknown commands are answered with 'E <command>'.
+
+V-sense follows V-in with a first order lag (the coil), times a gain, plus Gaussian noise. With protocol='binary'
+the device speaks the frames of binary_protocol.py instead.
+'''
+
+import math
+import time
+import threading
+
+from virtual_device import VirtualDevice
+import binary_protocol
+import playback_protocol
+
+
+class VirtualArduino(VirtualDevice):
+	def __init__(self,
+				 protocol='ascii',
+				 sense_gain=1.0,
+				 sense_time_constant=0.02,
+				 sense_noise=0.0,
+				 voltage_max=3000,
+				 table_capacity=512,
+				 burst_size=16,
+				 **transport
+				 ) -> None:
+		"""
+		:param protocol: 'ascii' or 'binary' (see binary_protocol.py)
+		:param sense_gain: V-sense / V-in in the steady state
+		:param sense_time_constant: time constant in s of V-sense following V-in
+		:param sense_noise: standard deviation of the V-sense noise in mV
+		:param voltage_max: initial Vmax in mV
+		:param table_capacity: maximal number of breakpoints of an uploaded waveform
+		:param burst_size: samples per #S line during the playback of an uploaded waveform
+		:param transport: baud_rate, latency, drop_rate, garble_rate, seed (see VirtualDevice)
+		"""
+		super().__init__(**transport)
+		self.protocol = protocol
+		self.sense_gain = sense_gain
+		self.sense_time_constant = sense_time_constant
+		self.sense_noise = sense_noise
+		self.voltage_max = voltage_max
+
+		self.auto_timeout_time = 0.2 # s
+		self.auto_timeout_on = False
+		self.print_all = False
+
+		self._v_in = {}		# tip -> set V-in
+		self._v_sense = {}	# tip -> (V-sense, time of the last update)
+		self._t_last_command = time.perf_counter()
+
+		# Uploaded waveform (see playback_protocol.py): tip, number of breakpoints, t_end and dt in us, the table
+		self.table_capacity = table_capacity
+		self.burst_size = burst_size
+		self._table = None
+		self._table_t = []
+		self._table_v = []
+		self._playing = threading.Event()
+		self._stop_playing = threading.Event()
+
+	def take_commands(self, buf: bytearray) -> list:
+		if self.protocol == 'binary':
+			return binary_protocol.take_frames(buf)
+		return super().take_commands(buf)
+
+	def handle_command(self, command: bytes):
+		self._apply_auto_timeout()
+		if self.protocol == 'binary':
+			return self._handle_frame(command)
+
+		parts = command.decode(errors='replace').strip().split(' ')
+		name, arguments = parts[0], parts[1:]
+		if len(command.rstrip(b'\r\n')) + 1 > playback_protocol.max_line_length:
+			# Would overflow the receive buffer of the Arduino.
+			return f'E {command.decode(errors="replace").strip()}\r\n'.encode()
+		try:
+			if self._playing.is_set() and name != '!WS':
+				return f'E {command.decode(errors="replace")}\r\n'.encode()
+			if name in ('?WC', '!WL', '!WD', '!WP', '!WS'):
+				return self._handle_playback(name, [int(x) for x in arguments])
+			if name == '!SI':
+				tip, voltage = int(arguments[0]), int(arguments[1])
+				return f'!SI {tip} {self.set_voltage(tip, voltage)}\r\n'.encode()
+			if name == '?SS':
+				return f'?SS {self.sense_voltage(int(arguments[0]))}\r\n'.encode()
+			if name == '!VM':
+				self.voltage_max = int(arguments[0])
+			elif name == '!TT':
+				self.auto_timeout_time = int(arguments[0]) / 1000
+			elif name == '!TO':
+				self.auto_timeout_on = bool(int(arguments[0]))
+			elif name == '!PA':
+				self.print_all = bool(int(arguments[0]))
+			else:
+				return f'E {command.decode(errors="replace")}\r\n'.encode()
+		except (IndexError, ValueError):
+			return f'E {command.decode(errors="replace")}\r\n'.encode()
+		return f'{name} {arguments[0]}\r\n'.encode()
+
+	def _handle_frame(self, frame: bytes):
+		try:
+			command, tip, value = binary_protocol.decode_frame(frame)
+		except binary_protocol.FrameError:
+			return binary_protocol.encode_frame(binary_protocol.CMD_ERROR, 0, 0)
+		if command == binary_protocol.CMD_SET_VOLTAGE:
+			return binary_protocol.encode_frame(command, tip, self.set_voltage(tip, value))
+		if command == binary_protocol.CMD_SENSE:
+			return binary_protocol.encode_frame(command, tip, self.sense_voltage(tip))
+		return binary_protocol.encode_frame(binary_protocol.CMD_ERROR, tip, command)
+
+	def _handle_playback(self, name: str, arguments: list):
+		error = f'E {" ".join([name] + [str(x) for x in arguments])}\r\n'.encode()
+		if name == '?WC':
+			return f'?WC {self.table_capacity}\r\n'.encode()
+		if name == '!WL':
+			tip, n, t_end, dt = arguments
+			if n > self.table_capacity or dt <= 0:
+				return error
+			self._table = (tip, n, t_end, dt)
+			self._table_t, self._table_v = [], []
+			return f'!WL {tip} {n}\r\n'.encode()
+		if name == '!WD':
+			i, pairs = arguments[0], arguments[1:]
+			t, v = pairs[0::2], pairs[1::2]
+			if self._table is None or i != len(self._table_t) or len(t) != len(v) or i + len(t) > self._table[1] \
+					or any(b < a for a, b in zip(self._table_t[-1:] + t, t)):
+				return error
+			self._table_t += t
+			self._table_v += v
+			return f'!WD {i} {len(t)}\r\n'.encode()
+		if name == '!WP':
+			if self._table is None or self._table[0] != arguments[0] or len(self._table_t) != self._table[1]:
+				return error
+			tip, _, t_end, dt = self._table
+			n_samples = -(-t_end // dt)
+			self._stop_playing.clear()
+			self._playing.set()
+			threading.Thread(target=self._play, args=(tip, n_samples, dt), name='virtual_arduino_playback', daemon=True).start()
+			return f'!WP {tip} {n_samples}\r\n'.encode()
+		if name == '!WS':
+			if not self._playing.is_set():
+				return error
+			self._stop_playing.set()
+			# Answered by the playback thread, after #WE.
+			return None
+
+	def _play(self, tip: int, n_samples: int, dt: int):
+		"""Playback of the uploaded table: sample k at k*dt us after the start, sent in bursts."""
+		t_start = time.perf_counter()
+		k = 0
+		v_in, v_sense = [], []
+		table_t, table_v = [-1] + self._table_t, [0] + self._table_v
+		j = 0
+		while k < n_samples and not self._stop_playing.is_set():
+			t_us = k * dt
+			while j + 1 < len(table_t) and table_t[j + 1] <= t_us:
+				j += 1
+			# The model of the coil runs on the clock of the device (the sample times), not on the host's.
+			self._v_in[tip] = max(0, min(table_v[j], self.voltage_max))
+			v_sense_now, _ = self._v_sense.get(tip, (0.0, 0))
+			target = self.sense_gain * self._v_in[tip]
+			decay = math.exp(-dt * 1e-6 / self.sense_time_constant) if self.sense_time_constant > 0 else 0
+			if k > 0:
+				v_sense_now = target + (v_sense_now - target) * decay
+			self._v_sense[tip] = (v_sense_now, time.perf_counter())
+			v_in.append(self._v_in[tip])
+			v_sense.append(int(round(v_sense_now + (self.random.gauss(0, self.sense_noise) if self.sense_noise else 0))))
+			k += 1
+			if len(v_in) == self.burst_size or k == n_samples:
+				# The burst goes out when its last sample has been taken.
+				time.sleep(max(0.0, t_start + (k - 1) * dt * 1e-6 - time.perf_counter()))
+				self.write((playback_protocol.encode_samples(k - len(v_in), v_in, v_sense) + '\r\n').encode())
+				v_in, v_sense = [], []
+		if v_in:
+			self.write((playback_protocol.encode_samples(k - len(v_in), v_in, v_sense) + '\r\n').encode())
+		self._update_sense(tip)
+		self._v_in[tip] = 0
+		self.write(f'#WE {k} 0\r\n'.encode())
+		if self._stop_playing.is_set():
+			self.write(f'!WS {tip}\r\n'.encode())
+		self._playing.clear()
+
+	# ------------------------------------------------------------------------------
+	# Model of the current generator
+
+	def set_voltage(self, tip: int, voltage: int) -> int:
+		self._update_sense(tip)
+		self._v_in[tip] = max(0, min(voltage, self.voltage_max))
+		return self._v_in[tip]
+
+	def sense_voltage(self, tip: int) -> int:
+		v_sense = self._update_sense(tip)
+		if self.sense_noise:
+			v_sense += self.random.gauss(0, self.sense_noise)
+		return int(round(v_sense))
+
+	def _update_sense(self, tip: int) -> float:
+		"""Advance the first order lag of V-sense of a tip to now and return it."""
+		now = time.perf_counter()
+		v_sense, t_last = self._v_sense.get(tip, (0.0, now))
+		target = self.sense_gain * self._v_in.get(tip, 0)
+		if self.sense_time_constant > 0:
+			v_sense = target + (v_sense - target) * math.exp(-(now - t_last) / self.sense_time_constant)
+		else:
+			v_sense = target
+		self._v_sense[tip] = (v_sense, now)
+		return v_sense
+
+	def _apply_auto_timeout(self):
+		now = time.perf_counter()
+		if self.auto_timeout_on and now - self._t_last_command > self.auto_timeout_time:
+			for tip in self._v_in:
+				self._update_sense(tip)
+				self._v_in[tip] = 0
+		self._t_last_command = now
@@ -0,0 +1,189 @@
+'''
+Voltage profiles for the tweezers, compiled ahead of the control loop.
+
+A profile is compiled once into a Waveform: sorted breakpoint times and the (piecewise constant) voltage that holds
+from each breakpoint to the next one. In the control loop the setpoint is then a single searchsorted() lookup, no
+matter how many pulses the protocol has.
+
+Profiles can be built with the functions below or from a spec dictionary with compile_profile(), for example:
+    compile_profile({'profile': 'multi_box', 't_on': 5, 't_off': 15, 'N_pulses': 10, 'voltage_ampl': 1000})
+'''
+
+import numpy as np
+
+
+t_signal_start = 2 #s
+t_after_signal = 3 #s  Recording continues for this long after the last pulse.
+dt_sampled = 0.01 #s  Resolution used for the profiles that are not piecewise constant (sine, user function).
+
+
+class Waveform:
+    def __init__(self, breakpoints, values, t_end: float) -> None:
+        """
+        Piecewise constant voltage profile.
+
+        :param breakpoints: increasing times in s, values[i] holds from breakpoints[i] to breakpoints[i+1]
+        :param values: voltages in mV (0 before the first breakpoint)
+        :param t_end: time in s at which the recording stops
+        """
+        self.breakpoints = np.asarray(breakpoints, dtype=float)
+        self.values = np.asarray(values, dtype=int)
+        self.t_end = t_end
+
+        if self.breakpoints.shape != self.values.shape:
+            raise ValueError(f'Got {len(self.breakpoints)} breakpoints and {len(self.values)} values.')
+        if np.any(np.diff(self.breakpoints) < 0):
+            raise ValueError('Breakpoints have to be sorted.')
+
+        # Lookups with a leading 0 V segment, so that searchsorted() never returns -1.
+        self._lookup_times = np.concatenate(([-np.inf], self.breakpoints))
+        self._lookup_values = np.concatenate(([0], self.values))
+
+    def value_at(self, t: float) -> int:
+        """Voltage in mV at time t (s from the start of the run)."""
+        i = np.searchsorted(self._lookup_times, t, side='right') - 1
+        return int(self._lookup_values[i])
+
+    def values_at(self, t):
+        """Voltages in mV for an array of times."""
+        i = np.searchsorted(self._lookup_times, t, side='right') - 1
+        return self._lookup_values[i]
+
+    def __len__(self):
+        return len(self.breakpoints)
+
+    def __repr__(self):
+        return f'Waveform({len(self)} breakpoints, t_end={self.t_end})'
+
+
+def edges(waveform: Waveform) -> np.ndarray:
+    """Times in s at which the voltage changes (breakpoints that keep the voltage are left out)."""
+    changes = np.diff(waveform._lookup_values) != 0
+    return waveform.breakpoints[changes]
+
+
+def adaptive_sample_times(waveform: Waveform, dT_edge: float, dT_plateau: float, window=(0.01, 0.1)) -> tuple:
+    """
+    Sample times for a run with adaptive sampling: every dT_edge around the edges of the waveform, every dT_plateau
+    in between.
+
+    :param window: (before, after) time in s around every edge that is sampled densely (after: for the coil to
+                   settle, a few time constants)
+    :return: times in s from 0 to before waveform.t_end, and for every time whether it is in a dense window
+    """
+    before, after = window
+    edge_times = edges(waveform)
+    offsets = np.arange(-before, after, dT_edge)
+    dense = (edge_times[:, None] + offsets[None, :]).ravel()
+    dense = dense[(dense >= 0) & (dense < waveform.t_end)]
+
+    sparse = np.arange(0, waveform.t_end, dT_plateau)
+    # Leave out the plateau samples inside a window.
+    i = np.searchsorted(edge_times, sparse, side='right')
+    edge_times = np.concatenate(([-np.inf], edge_times, [np.inf]))
+    outside = (sparse - edge_times[i] >= after) & (edge_times[i + 1] - sparse > before)
+    sparse = sparse[outside]
+
+    # Overlapping windows give the same times twice.
+    times, index = np.unique(np.round(np.concatenate((dense, sparse)), 9), return_index=True)
+    is_dense = index < len(dense)
+    if len(times) == 0 or times[0] > 0:
+        times, is_dense = np.concatenate(([0.0], times)), np.concatenate(([False], is_dense))
+    return times, is_dense
+
+
+def _pulses(t_starts, t_ons, voltages, t_end: float) -> Waveform:
+    """Waveform of box pulses: pulse i is voltages[i] from t_starts[i] for t_ons[i] seconds, 0 V in between."""
+    t_starts = np.asarray(t_starts, dtype=float)
+    t_stops = t_starts + np.asarray(t_ons, dtype=float)
+    voltages = np.broadcast_to(np.asarray(voltages, dtype=int), t_starts.shape)
+
+    breakpoints = np.empty(2*len(t_starts))
+    breakpoints[0::2] = t_starts
+    breakpoints[1::2] = t_stops
+    values = np.zeros(2*len(t_starts), dtype=int)
+    values[0::2] = voltages
+    return Waveform(breakpoints, values, t_end)
+
+
+def expand_sequence(sequence, N_pulses: int) -> list:
+    """
+    Expand a per-pulse parameter to N_pulses values (without modifying the given sequence).
+
+    A single number is repeated. If only [min, max] is given, the values are linearly interpolated (as floats, round
+    them where integers are needed). A sequence that is too short is continued with its last value.
+    """
+    if np.isscalar(sequence):
+        return [sequence]*N_pulses
+    if len(sequence) == 0:
+        raise ValueError('Empty per-pulse sequence: give a number, [min, max] or one value per pulse.')
+    if len(sequence) == 2 and N_pulses > 2:
+        return np.linspace(sequence[0], sequence[1], N_pulses).tolist()
+    sequence = list(sequence[:N_pulses])
+    return sequence + [sequence[-1]]*(N_pulses - len(sequence))
+
+
+def box(t_on: float, voltage_ampl: int) -> Waveform:
+    return _pulses([t_signal_start], [t_on], [voltage_ampl], t_signal_start + t_on + t_after_signal)
+
+
+def step(voltage_ampl: int, t_duration: float) -> Waveform:
+    """voltage_ampl from t_signal_start on, recorded for t_duration after the step."""
+    return Waveform([t_signal_start], [voltage_ampl], t_signal_start + t_duration)
+
+
+def multi_box(t_on: float, t_off: float, N_pulses: int, voltage_ampl: int) -> Waveform:
+    return multi_box_ampl_variation(t_on, t_off, N_pulses, [voltage_ampl])
+
+
+def multi_box_ampl_variation(t_on: float, t_off: float, N_pulses: int, voltage_ampl: list[int]) -> Waveform:
+    period = t_on + t_off
+    t_starts = t_signal_start + period*np.arange(N_pulses)
+    # DAC voltages are integers
+    voltages = np.rint(expand_sequence(voltage_ampl, N_pulses)).astype(int)
+    return _pulses(t_starts, [t_on]*N_pulses, voltages, t_signal_start + N_pulses*period + t_after_signal)
+
+
+def multi_box_t_on_variation(t_on: list[float], t_off: float, N_pulses: int, voltage_ampl: int) -> Waveform:
+    t_ons = np.asarray(expand_sequence(t_on, N_pulses), dtype=float)
+    # Pulse i starts after all the previous pulses and pauses.
+    t_starts = t_signal_start + np.concatenate(([0], np.cumsum(t_ons + t_off)[:-1]))
+    return _pulses(t_starts, t_ons, [voltage_ampl]*N_pulses, t_signal_start + t_ons.sum() + N_pulses*t_off + t_after_signal)
+
+
+def sine(t_on: float, voltage_ampl: int, frequency: float) -> Waveform:
+    """Sine between 0 and voltage_ampl for t_on seconds (sampled every dt_sampled)."""
+    return function(lambda t: 0.5*voltage_ampl*(1 + np.sin(2*np.pi*frequency*t)), t_on)
+
+
+def function(f, t_on: float) -> Waveform:
+    """
+    User function f(t) -> voltage in mV, applied for t_on seconds from t_signal_start on (sampled every dt_sampled).
+
+    f gets the time from the signal start and has to accept a NumPy array.
+    """
+    t = np.arange(0, t_on, dt_sampled)
+    values = np.rint(np.broadcast_to(f(t), t.shape)).astype(int)
+    breakpoints = np.append(t_signal_start + t, t_signal_start + t_on)
+    values = np.append(values, 0)
+    return Waveform(breakpoints, values, t_signal_start + t_on + t_after_signal)
+
+
+profiles = {
+    'box': box,
+    'step': step,
+    'multi_box': multi_box,
+    'multi_box_ampl_variation': multi_box_ampl_variation,
+    'multi_box_t_on_variation': multi_box_t_on_variation,
+    'sine': sine,
+    'function': function,
+}
+
+
+def compile_profile(spec: dict) -> Waveform:
+    """Compile a profile spec: {'profile': <name in profiles>, **parameters of that profile function}."""
+    spec = dict(spec)
+    name = spec.pop('profile')
+    if name not in profiles:
+        raise ValueError(f'Unknown profile "{name}". Known profiles: {list(profiles)}')
+    return profiles[name](**spec)